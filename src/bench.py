@@ -0,0 +1,283 @@
+"""Ingestion benchmark against a local DST stand-in
+
+Serves synthetic /tableinfo and /data responses shaped like the tables in tables/,
+loads them the way main does, and reports seconds and rows per second for the
+fetch, parse, validate and insert stages the load records. Tables with stream in
+their metadata go through the streamed pipeline.
+
+    python bench.py --codes 100 --periods 5 --db null --thresholds bench_thresholds.json
+
+--db null writes through a pool that only records the statements, which measures the
+python side of the writers. --db mysql writes to the database in BENCH_MARIADB_* env vars.
+"""
+import os
+os.environ.setdefault('MARIADB_USR', '')
+os.environ.setdefault('MARIADB_PSW', '')
+
+import argparse
+import asyncio
+import glob
+import itertools
+import json
+import logging
+import random
+import sys
+import tempfile
+from pathlib import Path
+from aiohttp import web
+
+from utils import utils, sql_utils, metrics_utils
+import settings
+
+
+# english texts for the variables in tables/, others get their id in lower case
+VARIABLE_TEXTS = {
+    'Tid': 'time',
+    'OMRÅDE': 'region',
+    'BOPOMR': 'region',
+    'KOEN': 'sex',
+    'ALDER': 'age',
+    'UDDANNELSEF': 'education',
+    'SOCIO': 'socioeconomic status',
+    'ERHVERV': 'industry',
+    'ENHED': 'unit',
+    'TYPE': 'type',
+    'PRODUKT': 'product',
+    'FORMÅL': 'purpose',
+    'INDKOMSTTYPE': 'type of income',
+    'VAREGR': 'commodity group',
+}
+STAGES = ['fetch', 'parse', 'validate', 'insert']
+
+
+class SyntheticTable():
+    """Tableinfo and data for a table in tables/, with codes_per_operator codes for operator variables like '>100'"""
+    def __init__(self, metadata: dict, codes_per_operator: int, periods: int):
+        self.table_id = metadata['table_id']
+        self.variables = {}
+        for variable_id, values in metadata['dst_variables'].items():
+            if variable_id == 'Tid':
+                monthly = 'M' in values[0]
+                codes = [f'{2015 + i // 12}M{i % 12 + 1:02d}' if monthly else f'{2015 + i}' for i in range(periods)]
+            elif utils.parse_operator_value(values[0]):
+                start = int(utils.parse_operator_value(values[0])[1])
+                codes = [str(start + 1 + i) for i in range(codes_per_operator)]
+            else:
+                codes = list(values)
+            text = VARIABLE_TEXTS.get(variable_id, variable_id.lower())
+            # DST labels periods with the code itself, parse_time_column relies on that
+            labels = list(codes) if variable_id == 'Tid' else [f'{text} {code}' for code in codes]
+            self.variables[variable_id] = (text, codes, labels)
+
+    def table_info(self):
+        return {
+            'id': self.table_id,
+            'variables': [{'id': variable_id, 'text': text, 'values': [{'id': code, 'text': label} for code, label in zip(codes, labels)]}
+                          for variable_id, (text, codes, labels) in self.variables.items()],
+        }
+
+    def resolve(self, variable_id: str, value: str):
+        _, codes, _ = self.variables[variable_id]
+        if value is None:
+            return codes[:1]
+        if value == '*':
+            return codes
+        if utils.parse_operator(value):
+            string_operator, bound = utils.parse_operator(value)
+            if utils.parse_operator_value(value):
+                return [code for code in codes if utils.logical_operator_render(value, code, string_operator)]
+            compare = {'>': str.__gt__, '>=': str.__ge__, '<': str.__lt__, '<=': str.__le__}.get(string_operator, str.__eq__)
+            return [code for code in codes if compare(code, bound)]
+        return [code for code in value.split(',') if code in codes]
+
+    def lines(self, query: dict, use_codes: bool=False):
+        selected = []
+        for variable_id, (_, codes, labels) in self.variables.items():
+            label_lookup = dict(zip(codes, labels))
+            selected.append([code if use_codes else label_lookup[code] for code in self.resolve(variable_id, query.get(variable_id))])
+        yield ';'.join([variable_id.upper() for variable_id in self.variables] + ['INDHOLD']) + '\n'
+        for row in itertools.product(*selected):
+            yield ';'.join(row) + f';{random.randint(0, 100000)}\n'
+
+
+def make_app(tables: dict):
+    async def table_info(request: web.Request):
+        return web.json_response(tables[request.match_info['table_id']].table_info())
+
+    async def tables_catalog(request: web.Request):
+        # every table is reported as published at the same time, so a second run of main sees them unchanged
+        return web.json_response([{'id': table.table_id, 'text': table.table_id, 'updated': '2015-01-01T08:00:00', 'active': True,
+                                   'variables': [text for text, _, _ in table.variables.values()]} for table in tables.values()])
+
+    async def data(request: web.Request):
+        table = tables[request.match_info['table_id']]
+        use_codes = request.query.get('valuePresentation') == 'Code'
+        response = web.StreamResponse(headers={'Content-Type': 'text/csv; charset=utf-8'})
+        await response.prepare(request)
+        chunk = []
+        for line in table.lines(request.query, use_codes):
+            chunk.append(line)
+            if len(chunk) >= 10000:
+                await response.write(''.join(chunk).encode('utf-8'))
+                chunk = []
+        await response.write(''.join(chunk).encode('utf-8'))
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_get('/v1/tables', tables_catalog)
+    app.router.add_get('/v1/tableinfo/{table_id}', table_info)
+    app.router.add_get('/v1/data/{table_id}/{out_format}', data)
+    return app
+
+
+class NullCursor():
+    def __init__(self, pool):
+        self.pool = pool
+        self.rowcount = 0
+
+    async def execute(self, sql_query: str, args=None):
+        self.pool.round_trips += 1
+
+    async def executemany(self, sql_query: str, args):
+        self.pool.round_trips += 1
+        self.rowcount = len(args)
+
+    async def fetchone(self):
+        return (0, )
+
+    async def fetchall(self):
+        return []
+
+    async def close(self):
+        pass
+
+
+class NullConnection():
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def cursor(self):
+        return NullCursor(self.pool)
+
+
+class NullPool():
+    """Stands in for an aiomysql pool, counting round trips and discarding the statements"""
+    def __init__(self):
+        self.round_trips = 0
+
+    async def acquire(self):
+        return NullConnection(self)
+
+    async def release(self, conn):
+        pass
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+async def bench_table(dst, mysql_engine_pool, metadata: dict, load_mode: str):
+    # the table goes through the same load as in main, so the parse executor, the cell limit split, the raw
+    # cache and the streamed pipeline are all measured. The stages come from the metrics the load records
+    import main
+    metadata = dict(metadata, load_mode=load_mode)
+    table_name = f"{settings.MARIADB_CONFIG['db']}.bench_dst_{metadata['table_id'].lower()}"
+    db_slots = asyncio.Semaphore(settings.DB_WRITE_CONCURRENCY)
+    await sql_utils.drop_table(mysql_engine_pool, table_name)
+    with metrics_utils.table_run(metadata['table_id']) as table_metrics:
+        if metadata.get('stream', False):
+            await main.load_table_stream(metadata, dst, mysql_engine_pool, db_slots, table_name)
+        else:
+            await main.load_table(metadata, dst, mysql_engine_pool, db_slots, table_name)
+    await sql_utils.drop_table(mysql_engine_pool, table_name)
+
+    stages = table_metrics.to_dict()
+    # fetch counts bytes, the rows it delivered are the ones parsed
+    stages['fetch']['rows'] = stages['parse']['rows']
+    return {stage: {'seconds': stages[stage]['seconds'], 'rows': stages[stage]['rows'], 'rows_per_second': round(stages[stage]['rows'] / max(stages[stage]['seconds'], 1e-6)), 'rss_kb': stages[stage]['rss_kb'], 'rss_growth_kb': stages[stage]['rss_growth_kb']} for stage in STAGES}
+
+
+def check_thresholds(summary: dict, thresholds: dict):
+    # thresholds are minimum rows per second per stage, over all tables
+    regressions = []
+    for stage, min_rows_per_second in thresholds.items():
+        if summary[stage]['rows_per_second'] < min_rows_per_second:
+            regressions.append(f"{stage} ran at {summary[stage]['rows_per_second']} rows/s, below the threshold of {min_rows_per_second}")
+    return regressions
+
+
+async def run(args):
+    # the dst client keeps its caches in a throwaway folder pointed at the local server
+    settings.CACHE_PATH = Path(tempfile.mkdtemp(prefix='dst_bench_'))
+    settings.RAW_CACHE = False
+    metadata_lst = [utils.read_json(metadata_file) for metadata_file in sorted(glob.glob(settings.METADATA_PATH.absolute().as_posix() + '/*.json'))]
+    if args.tables:
+        metadata_lst = [metadata for metadata in metadata_lst if metadata['table_id'] in args.tables]
+    tables = {metadata['table_id']: SyntheticTable(metadata, args.codes, args.periods) for metadata in metadata_lst}
+
+    runner = web.AppRunner(make_app(tables))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', args.port)
+    await site.start()
+    settings.DST_BASE_URL = f'http://127.0.0.1:{args.port}/v1'
+    from dst import DST
+
+    if args.db == 'mysql':
+        settings.MARIADB_CONFIG = {
+            'user': os.environ['BENCH_MARIADB_USR'],
+            'psw': os.environ.get('BENCH_MARIADB_PSW', ''),
+            'host': os.environ.get('BENCH_MARIADB_HOST', '127.0.0.1'),
+            'port': int(os.environ.get('BENCH_MARIADB_PORT', 3306)),
+            'db': os.environ.get('BENCH_MARIADB_DB', 'bench'),
+        }
+        mysql_engine_pool = await sql_utils.async_mysql_create_engine(loop=asyncio.get_event_loop(), db_config=settings.MARIADB_CONFIG, maxsize=settings.INSERT_CONCURRENCY + 1, local_infile=True)
+    else:
+        mysql_engine_pool = NullPool()
+
+    results = {}
+    try:
+        async with DST() as dst:
+            for metadata in metadata_lst:
+                results[metadata['table_id']] = await bench_table(dst, mysql_engine_pool, metadata, args.load_mode or metadata.get('load_mode', 'INSERT'))
+                logging.info(f"{metadata['table_id']}: " + ', '.join([f"{stage} {result['rows_per_second']} rows/s" for stage, result in results[metadata['table_id']].items()]))
+    finally:
+        mysql_engine_pool.close()
+        await mysql_engine_pool.wait_closed()
+        await runner.cleanup()
+
+    summary = {}
+    for stage in STAGES:
+        seconds = sum([result[stage]['seconds'] for result in results.values()])
+        rows = sum([result[stage]['rows'] for result in results.values()])
+        summary[stage] = {'seconds': round(seconds, 4), 'rows': rows, 'rows_per_second': round(rows / max(seconds, 1e-6))}
+    report = {'tables': results, 'summary': summary}
+    if isinstance(mysql_engine_pool, NullPool):
+        report['db_round_trips'] = mysql_engine_pool.round_trips
+    print(json.dumps(report, indent=4))
+
+    if args.thresholds:
+        regressions = check_thresholds(summary, utils.read_json(args.thresholds))
+        for regression in regressions:
+            logging.error(regression)
+        return 1 if regressions else 0
+    return 0
+
+
+def parse_args(argv: list=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--codes', type=int, default=100, help='codes generated for operator variables like >100')
+    parser.add_argument('--periods', type=int, default=5, help='periods in the time variable')
+    parser.add_argument('--tables', nargs='*', help='table ids to run, default all in tables/')
+    parser.add_argument('--db', choices=['null', 'mysql'], default='null')
+    parser.add_argument('--load-mode', choices=['INSERT', 'INFILE'], help='overrides load_mode from the metadata')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--thresholds', help='json file with minimum rows per second per stage')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    sys.exit(asyncio.run(run(parse_args())))
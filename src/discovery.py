@@ -0,0 +1,58 @@
+import re
+import asyncio
+import logging
+import numpy as np
+from typing import List
+
+from dst import DST
+from utils import utils
+import settings
+
+
+async def discover_tables(dst: DST, subject_ids: List[str]=None, id_pattern: str=None, past_days: int=None):
+    # the catalog is read one subject at a time, all subjects at once, and the tables are filtered by id pattern.
+    # past_days keeps only the tables DST has updated in that many days
+    if not subject_ids:
+        subject_ids = [subject['id'] for subject in await dst.get_subjects()]
+    catalogs = await asyncio.gather(*[dst.get_tables(subject_ids=[subject_id], past_days=past_days) for subject_id in subject_ids])
+    tables = {}
+    for catalog in catalogs:
+        for table in catalog:
+            if table.get('active', True) and (not id_pattern or re.fullmatch(id_pattern, table['id'], flags=re.IGNORECASE)):
+                tables[table['id']] = table
+    logging.info(f'discovered {len(tables)} tables under the subjects {", ".join(subject_ids)}')
+    return list(tables.values())
+
+
+async def table_job(dst: DST, table: dict):
+    # a job spec like the files in tables/, asking for every code. Tid is narrowed to the periods after the
+    # latest loaded one by ingest_table, so '*' only applies to the first load
+    table_index, col_names_dct = await dst.get_table_index(table['id'])
+    cells = int(np.prod([len(variable_index) for variable_index in table_index.values()], dtype=float))
+    stream = cells > settings.DST_CELL_LIMIT
+    return {
+        'table_id': table['id'],
+        'index_vars': suggest_indexes(table_index, col_names_dct),
+        'dst_variables': {variable_id: ['*'] for variable_id in table_index},
+        'format': 'BULK' if stream else 'CSV',
+        'stream': stream,
+        'discovered': True,
+    }
+
+
+def suggest_indexes(table_index: dict, col_names_dct: dict):
+    # time plus the dimensions with the most codes, which are the most selective filters. Dimensions with a handful
+    # of codes are cheaper to scan than to index
+    cardinalities = {variable_id: len(variable_index) for variable_id, variable_index in table_index.items() if variable_id != 'Tid'}
+    selective = sorted([variable_id for variable_id, cardinality in cardinalities.items() if cardinality >= settings.DISCOVER_INDEX_MIN_CODES], key=lambda variable_id: -cardinalities[variable_id])
+    col_names = utils.column_names(col_names_dct)
+    return ['time'] + [col_names[variable_id] for variable_id in selective[:settings.DISCOVER_MAX_INDEXES]]
+
+
+async def discover_jobs(dst: DST, subject_ids: List[str]=None, id_pattern: str=None, past_days: int=None):
+    tables = await discover_tables(dst, subject_ids, id_pattern, past_days)
+    jobs = await asyncio.gather(*[table_job(dst, table) for table in tables], return_exceptions=True)
+    for table, job in zip(tables, jobs):
+        if isinstance(job, Exception):
+            logging.warning(f"skipping discovered table {table['id']}, its tableinfo failed with {job!r}")
+    return [job for job in jobs if not isinstance(job, Exception)]
@@ -2,20 +2,53 @@ import settings
 from typing import List, Dict
 import jmespath
 import pandas as pd
+import numpy as np
 import re
 import asyncio
+import time
 from aiohttp import ClientSession
 import aiohttp
-from itertools import compress
-from io import StringIO
+import json
+from yarl import URL
+from io import StringIO, BytesIO
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import nullcontext
 import logging
-from utils import utils
+from utils import utils, metrics_utils
+from utils.cache_utils import TableInfoCache, RawResponseCache
+from utils.code_index import build_table_index, split_request
+from utils.http_utils import TokenBucket, RETRY_STATUSES, backoff_delay, retry_after_delay
+
+
+VALUE_IDS = jmespath.compile('values[].id')
+VALUE_TEXTS = jmespath.compile('values[].text')
+VARIABLE_TEXT = jmespath.compile('text')
+# the content of confidential or missing cells
+MISSING_VALUE = '..'
 
 
 class DST():
-    def __init__(self):
+    def __init__(self, replay: bool=False):
         self.base_url = settings.DST_BASE_URL
-        self.session = ClientSession()
+        # replay answers data requests from the raw cache only, without touching the network
+        self.replay = replay
+        self.raw_cache = RawResponseCache(settings.CACHE_PATH / 'raw', compresslevel=settings.RAW_CACHE_COMPRESSLEVEL) if settings.RAW_CACHE or replay else None
+        connector = aiohttp.TCPConnector(limit=settings.DST_CONNECTION_LIMIT,
+                                         ttl_dns_cache=settings.DST_DNS_CACHE_TTL,
+                                         keepalive_timeout=settings.DST_KEEPALIVE_TIMEOUT)
+        # no total timeout, since bulk extracts stream for a long time, but a stalled read is a failure
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=settings.DST_CONNECT_TIMEOUT, sock_read=settings.DST_READ_TIMEOUT)
+        self.session = ClientSession(connector=connector, timeout=timeout)
+        self.rate_limiters = {}
+        self.http_slots = asyncio.Semaphore(settings.DST_CONCURRENCY)
+        # a process pool parses without holding the GIL of the event loop, at the cost of pickling batches and frames
+        if settings.PARSE_EXECUTOR == 'process':
+            self.parse_executor = ProcessPoolExecutor(max_workers=settings.PARSE_WORKERS)
+        else:
+            self.parse_executor = ThreadPoolExecutor(max_workers=settings.PARSE_WORKERS)
+        self.table_info_cache = TableInfoCache(settings.CACHE_PATH / 'tableinfo', ttl=settings.TABLEINFO_TTL)
+        self.table_indexes = {}
 
     async def get_table_info(self, table_id: str, params: dict=None):
         default_params = {
@@ -25,21 +58,141 @@ class DST():
         url = f"{self.base_url}/tableinfo/{table_id}"
         if not params:
             params = default_params
-        res = await self.get(url, params)
-        variables = res['variables']
-        return variables
+        lang = params.get('lang', 'en')
+        entry = self.table_info_cache.get(table_id, lang)
+        if entry and (self.replay or self.table_info_cache.is_fresh(entry)):
+            return entry['variables']
+        if self.replay:
+            raise FileNotFoundError(f'no cached tableinfo for {table_id}, it has to run online first')
+
+        async with self.http_slots:
+            res = await self.send('GET', url, ok_statuses=(200, 304), params=params, headers=self.table_info_cache.revalidation_headers(entry))
+            if res.status == 304 and entry:
+                res.release()
+                logging.info(f'tableinfo for {table_id} is unchanged')
+                return self.table_info_cache.touch(table_id, lang, entry)['variables']
+            table_info = await self.read_response(res, 'JSON')
+        entry = self.table_info_cache.put(table_id, lang, table_info['variables'], res.headers.get('ETag'), res.headers.get('Last-Modified'))
+        return entry['variables']
+
+    async def get_subjects(self, subject_ids: List[str]=None):
+        # the subjects directly under subject_ids, or the top level subjects
+        params = {'format': 'JSON', 'lang': 'en', 'recursive': 'false'}
+        if subject_ids:
+            params['subjects'] = ','.join(subject_ids)
+        return await self.get(f'{self.base_url}/subjects', params)
+
+    async def get_tables(self, subject_ids: List[str]=None, past_days: int=None, include_inactive: bool=False):
+        # the catalog entries, with id, text, updated, firstPeriod, latestPeriod and variables, of every table under subject_ids
+        params = {'format': 'JSON', 'lang': 'en'}
+        if subject_ids:
+            params['subjects'] = ','.join(subject_ids)
+        if past_days:
+            params['pastDays'] = past_days
+        if include_inactive:
+            params['includeInactive'] = 'true'
+        return await self.get(f'{self.base_url}/tables', params)
+
+    async def get_tables_updated(self, table_ids: List[str]):
+        # one catalog request gives the last publication time of every table, instead of a tableinfo request per table
+        if self.replay:
+            return {}
+        tables = await self.get_tables(include_inactive=True)
+        table_ids = {table_id.upper() for table_id in table_ids}
+        return {table['id'].upper(): table['updated'] for table in tables if table['id'].upper() in table_ids}
 
     async def get_table(self, table_id: str, variables: List[Dict], params: dict=None, request_type: str='POST', out_format: str='CSV'):
-        def special_case_values(variable_values: list, table_variables_values: list):
-            if re_obj := re.search('(>|<)(=|)', variable_values[0]):
-                operator = re_obj[0]
-                boolean_filter = [utils.logical_operator_render(variable_values[0], table_value, operator) for table_value in table_variables_values]
-                new_variable_values = list(compress(table_variables_values, boolean_filter))
-                #new_variable_values = [int(value) for value in new_variable_values]
-            else:
-                raise ValueError('a special case variable is a variable, that is using an operator, but the endpoint wont accept operators')
-            return new_variable_values
+        sub_requests = await self.table_requests(table_id, variables)
+        if len(sub_requests) == 1:
+            df = await self.get_table_part(table_id, sub_requests[0], params, request_type, out_format)
+        else:
+            logging.info(f'{table_id} is over the cell limit, fetching it as {len(sub_requests)} requests')
+            dfs = await asyncio.gather(*[self.get_table_part(table_id, sub_variables, params, request_type, out_format) for sub_variables in sub_requests])
+            df = pd.concat(dfs, ignore_index=True)
+        if self.raw_cache and not self.replay:
+            self.raw_cache.write_manifest(table_id, sub_requests)
+        return df
+
+    async def table_requests(self, table_id: str, variables: Dict[str, List[str]]):
+        # a replay repeats the requests of the last cached fetch. The Tid filter the caller builds from the db
+        # has moved after a partial load, and is gone after the table was dropped for a schema change
+        if self.replay:
+            return self.raw_cache.read_manifest(table_id)
+        return await self.split_table_request(table_id, variables)
+
+    async def split_table_request(self, table_id: str, variables: Dict[str, List[str]]):
+        # estimates the cells of the request from the tableinfo, and splits it to stay under the api limit.
+        # Variables that aren't split keep their original expression
+        table_index, _ = await self.get_table_index(table_id)
+        resolved = {key: table_index[key].resolve(values) if key in table_index else values for key, values in variables.items()}
+        sub_requests = split_request(resolved, settings.DST_CELL_LIMIT)
+        if len(sub_requests) == 1:
+            return [variables]
+        return [{key: variables[key] if values == resolved[key] else values for key, values in sub_variables.items()} for sub_variables in sub_requests]
+
+    async def get_table_part(self, table_id: str, variables: List[Dict], params: dict=None, request_type: str='POST', out_format: str='CSV'):
+        url, payload, table_index, col_names_dct = await self.prepare_table_request(table_id, variables, params, request_type, out_format)
+        raw_key = self.raw_cache.key(table_id, out_format, url, payload) if self.raw_cache else None
+        with metrics_utils.span('fetch'):
+            if self.replay:
+                raw = self.raw_cache.read(raw_key)
+                metrics_utils.record(bytes=len(raw))
+                res = raw.decode('utf-8-sig')
+            elif request_type == 'POST':
+                res = await self.post(url, payload, return_type='TEXT')
+            elif request_type == 'GET':
+                res = await self.get(url, payload, return_type='TEXT')
+        if self.raw_cache and not self.replay:
+            self.raw_cache.write(raw_key, res.encode('utf-8'))
+
+        # parsing is cpu bound, so keep it off the event loop
+        loop = asyncio.get_event_loop()
+        with metrics_utils.span('parse') as stage_metrics:
+            df = await loop.run_in_executor(self.parse_executor, partial(pd.read_csv, StringIO(res), sep=';', dtype=str))
+            stage_metrics.add(rows=len(df))
+        return self.validate_table(df, table_index, col_names_dct)
+
+    async def stream_raw_batches(self, table_id: str, variables: List[Dict], params: dict=None, request_type: str='POST', out_format: str='CSV', batch_rows: int=50000):
+        # yields the unparsed lines of the response in batches, so the caller decides where and when they are parsed.
+        # Tables over the cell limit are streamed one request after the other
+        sub_requests = await self.table_requests(table_id, variables)
+        for sub_variables in sub_requests:
+            async for raw_batch in self.stream_request(table_id, sub_variables, params, request_type, out_format, batch_rows):
+                yield raw_batch
+        if self.raw_cache and not self.replay:
+            self.raw_cache.write_manifest(table_id, sub_requests)
 
+    async def stream_request(self, table_id: str, variables: List[Dict], params: dict=None, request_type: str='POST', out_format: str='CSV', batch_rows: int=50000):
+        url, payload, table_index, col_names_dct = await self.prepare_table_request(table_id, variables, params, request_type, out_format)
+        raw_key = self.raw_cache.key(table_id, out_format, url, payload) if self.raw_cache else None
+        if self.replay:
+            with self.raw_cache.open(raw_key) as raw_file:
+                async for header, lines in batch_lines(iterate_async(raw_file), batch_rows):
+                    yield header, lines, table_index, col_names_dct
+            return
+
+        async with self.http_slots:
+            # only the request itself is retried, a failure mid stream would duplicate the batches already yielded
+            if request_type == 'POST':
+                res = await self.send('POST', url, data=payload)
+            elif request_type == 'GET':
+                res = await self.send('GET', url, params=payload)
+            try:
+                with self.raw_cache.writer(raw_key) if self.raw_cache else nullcontext() as raw_file:
+                    async for header, lines in batch_lines(copy_lines(res.content, raw_file), batch_rows):
+                        yield header, lines, table_index, col_names_dct
+            finally:
+                res.release()
+
+    async def parse_batch(self, header: bytes, lines: List[bytes], table_index: dict, col_names_dct: dict):
+        # parsing and the total filter are cpu bound, so both run in the parse executor, which may be a process pool
+        loop = asyncio.get_event_loop()
+        df, parsed_rows, parse_seconds, validate_seconds, worker_rss = await loop.run_in_executor(self.parse_executor, partial(parse_csv_batch, header + b''.join(lines), table_index, col_names_dct))
+        metrics_utils.add('parse', seconds=parse_seconds, calls=1, rows=parsed_rows, **worker_rss)
+        metrics_utils.add('validate', seconds=validate_seconds, calls=1, rows=len(df), **worker_rss)
+        return df
+
+    async def prepare_table_request(self, table_id: str, variables: List[Dict], params: dict=None, request_type: str='POST', out_format: str='CSV'):
         #default_params = {
         #            "valuePresentation": "Default",
         #            "allowCodeOverrideInColumnNames": "true", # gives english column names coupled with lang en
@@ -48,25 +201,24 @@ class DST():
         default_params = {
                     "valuePresentation": "Default",
                     }
-        table_info = await self.get_table_info(table_id)
-        table_variables, col_names_dct = self.format_table_info(table_info)
-        assert all([key in table_variables.keys() for key in variables.keys()]), 'You have provided a variable not available in this table'
+        table_index, col_names_dct = await self.get_table_index(table_id)
+        assert all([key in table_index for key in variables.keys()]), 'You have provided a variable not available in this table'
         for key, values in variables.items():
             if key == 'Tid':
                 continue
-            if re.search('(\*)', values[0]):
+            if '*' in values[0]:
                 pass
-            elif re_obj := re.search('(>|<)(=|)', values[0]):
-                operator = re_obj[0]
-                assert any([utils.logical_operator_render(values[0], table_value, operator) for table_value in table_variables[key]]), f'There is no match for this operator and code value in the values of {key}'
+            elif utils.parse_operator_value(values[0]):
+                assert table_index[key].match(values[0]), f'There is no match for this operator and code value in the values of {key}'
             else:
-                assert all([value in table_variables[key] for value in values]), f'You have provided code values not available for key {key}'
-        for key in variables.keys():
-            if key in ['OMRÅDE', 'BOPOMR']:
-                variables[key] = special_case_values(variables[key], table_variables[key])
+                missing = table_index[key].missing(values)
+                assert not missing, f'You have provided code values not available for key {key}: {missing}'
+        # the endpoint wont accept operators for these, so they are expanded to the matching codes
+        variables = {key: table_index[key].match(values[0]) if key in ['OMRÅDE', 'BOPOMR'] and utils.parse_operator_value(values[0]) else values for key, values in variables.items()}
 
         if not params:
             params = default_params
+        params = dict(params)
 
         if request_type == 'POST':
             url = f"{self.base_url}/data"
@@ -75,69 +227,214 @@ class DST():
             body = params
             body['table'] = table_id
             body['variables'] = variables_body
-            res = await self.post(url, body, return_type='TEXT')
+            payload = body
 
         elif request_type == 'GET':
             url = f"{self.base_url}/data/{table_id}/{out_format}"
             variables_dct = {k:','.join(v) for k,v in variables.items()}
             #variables_str = '&'.join([f"{k}={','.join(v)}" for k,v in variables.items()])
-            params = {**params, **variables_dct}
-            res = await self.get(url, params, return_type='TEXT')
+            payload = {**params, **variables_dct}
+        return url, payload, table_index, col_names_dct
 
-        df = pd.read_csv(StringIO(res), sep=';')
+    def validate_table(self, df: pd.DataFrame, table_index: dict, col_names_dct: dict):
+        with metrics_utils.span('validate') as stage_metrics:
+            df = self.format_table(df, table_index, col_names_dct)
+            stage_metrics.add(rows=len(df))
+        return df
 
+    @staticmethod
+    def format_table(df: pd.DataFrame, table_index: dict, col_names_dct: dict):
         # make cols english
-        col_names_dct = {k.upper(): v.replace(' ', '_') for k,v in col_names_dct.items()}
+        variable_ids = {k.upper(): k for k in col_names_dct.keys()}
+        col_names_dct = {k.upper(): v for k,v in utils.column_names(col_names_dct).items()}
         col_names_dct['INDHOLD'] = 'content'
         df.columns = df.columns.str.upper()
+        dimension_cols = {col_names_dct[col]: variable_ids[col] for col in list(df) if col in variable_ids and variable_ids[col] != 'Tid'}
         df = df.rename(col_names_dct, axis=1)
 
-        # clean some totals
-        for col in list(df):
-            if df[col].dtype == 'object':
-                df = df.loc[~df[col].str.contains(', total')]
+        # dimensions become categories, and total rows are found on the few categories, not on every row.
+        # DST labels its total values '<something>, total', the tableinfo doesn't mark them otherwise.
+        # With valuePresentation Code the values are code ids, so the codes of total values are checked too.
+        # The masks are combined, so the frame is only copied once
+        keep = np.ones(len(df), dtype=bool)
+        for col, variable_id in dimension_cols.items():
+            if df[col].dtype != 'object':
+                continue
+            df[col] = df[col].astype('category')
+            categories = df[col].cat.categories
+            total_values = table_index[variable_id].total_labels | table_index[variable_id].total_codes
+            is_total = categories.isin(total_values) | categories.astype(str).str.contains(', total', regex=False)
+            if is_total.any():
+                is_total = np.append(is_total, False) # code -1 is a missing value
+                keep &= ~is_total[df[col].cat.codes.values]
+        if not keep.all():
+            df = df.loc[keep].reset_index(drop=True)
+            for col in dimension_cols.keys():
+                if df[col].dtype.name == 'category':
+                    df[col] = df[col].cat.remove_unused_categories()
+
+        # DST marks confidential or missing values with '..', those become NaN. Anything else that doesn't parse
+        # means the format of the data changed, and is an error rather than a column of NULLs. content is stored
+        # as a single precision FLOAT, so float32 holds it without losing anything more
+        content = df['content'].where(df['content'] != MISSING_VALUE)
+        numeric = pd.to_numeric(content, errors='coerce')
+        unparsed = content[numeric.isna() & content.notna()]
+        if len(unparsed):
+            raise ValueError(f"{len(unparsed)} content values are not numbers, like {', '.join(map(str, unparsed.unique()[:5]))}")
+        df['content'] = numeric.astype('float32')
         return df
 
+    async def get_dimensions(self, table_id: str):
+        # the index of every dimension variable, keyed by the english column name it gets in format_table
+        table_index, col_names_dct = await self.get_table_index(table_id)
+        col_names = utils.column_names(col_names_dct)
+        return {col_names[variable_id]: table_index[variable_id] for variable_id in col_names_dct if variable_id != 'Tid'}
+
+    async def get_table_index(self, table_id: str):
+        # the index is rebuilt only when the tableinfo cache hands back a different response
+        table_info = await self.get_table_info(table_id)
+        cached = self.table_indexes.get(table_id)
+        if cached and cached[0] is table_info:
+            return cached[1], cached[2]
+        table_variables, col_names_dct = self.format_table_info(table_info)
+        table_index = build_table_index(table_variables, {table_variable['id']: VALUE_TEXTS.search(table_variable) for table_variable in table_info})
+        self.table_indexes[table_id] = (table_info, table_index, col_names_dct)
+        return table_index, col_names_dct
+
     def format_table_info(self, table_variables: List[Dict]):
-        variables_dct =  {table_variable['id']: jmespath.search('values[].id', table_variable) for table_variable in table_variables}
-        col_names_dct = {table_variable['id']: jmespath.search('text', table_variable) for table_variable in table_variables}
+        variables_dct =  {table_variable['id']: VALUE_IDS.search(table_variable) for table_variable in table_variables}
+        col_names_dct = {table_variable['id']: VARIABLE_TEXT.search(table_variable) for table_variable in table_variables}
         return variables_dct, col_names_dct
 
 
 # what is stub????? Det er desuden angivet, at variablen område skal placeres i tabellens forspalte (angives som hoved (head) eller forspalte (stub)).
 # remember we can query like >=2010K1<=2015K4 
     async def post(self, url: str, body: dict, return_type: str='JSON'):
-        res = await self.session.post(url, data=body)
-        if res.status != 200:
-            message = await res.json()
-            raise AssertionError(f"Status for request is {res.status} with reason {res.reason} and message: {message['message']}")
-        if return_type == 'JSON':
-            try:
-                res = await res.json()
-            except aiohttp.ContentTypeError:
-                import json
-                res = await res.text()
-                res = json.loads(res)
-        elif return_type == 'TEXT':
-            res = await res.text()
-        return res
+        async with self.http_slots:
+            return await self.send('POST', url, return_type=return_type, data=body)
 
     async def get(self, url: str, params: dict, return_type: str='JSON'):
-        res = await self.session.get(url, params=params)
-        if res.status != 200:
-            message = await res.json()
-            raise AssertionError(f"Status for request is {res.status} with reason {res.reason} and message: {message['message']}")
-        if return_type == 'JSON':
+        async with self.http_slots:
+            return await self.send('GET', url, return_type=return_type, params=params)
+
+    async def send(self, method: str, url: str, ok_statuses: tuple=(200, ), return_type: str=None, **kwargs):
+        # rate limited request, retried with jittered exponential backoff on throttling, server errors and timeouts.
+        # With return_type the body is read inside the retries, since a large body takes far longer to read than
+        # the headers. Without it the response is returned unread, for callers that stream it
+        host = URL(url).host
+        if host not in self.rate_limiters:
+            self.rate_limiters[host] = TokenBucket(settings.DST_RATE_LIMIT, settings.DST_RATE_BURST)
+        rate_limiter = self.rate_limiters[host]
+        for attempt in range(settings.DST_RETRIES + 1):
+            await rate_limiter.acquire()
+            res = None
             try:
-                res = await res.json()
-            except aiohttp.ContentTypeError:
-                import json
-                res = await res.text()
-                res = json.loads(res)
+                res = await self.session.request(method, url, **kwargs)
+                if return_type and res.status in ok_statuses:
+                    return await self.read_response(res, return_type)
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+                if res is not None:
+                    res.release()
+                if attempt == settings.DST_RETRIES:
+                    raise
+                delay = backoff_delay(attempt, settings.DST_BACKOFF_BASE, settings.DST_BACKOFF_CAP)
+                logging.warning(f'{method} {url} failed with {e!r}, retrying in {delay:.1f} s')
+                await asyncio.sleep(delay)
+                continue
+            if res.status in ok_statuses:
+                return res
+            if res.status in RETRY_STATUSES and attempt < settings.DST_RETRIES:
+                delay = retry_after_delay(res.headers) or backoff_delay(attempt, settings.DST_BACKOFF_BASE, settings.DST_BACKOFF_CAP)
+                res.release()
+                logging.warning(f'{method} {url} returned {res.status}, retrying in {delay:.1f} s')
+                await asyncio.sleep(delay)
+                continue
+            raise await self.status_error(res)
+
+    async def status_error(self, res: aiohttp.ClientResponse):
+        # error bodies are usually json with a message, but proxies and timeouts send html or nothing
+        body = await res.text()
+        try:
+            message = json.loads(body)['message']
+        except (ValueError, KeyError, TypeError):
+            message = body[:500]
+        return AssertionError(f"Status for request is {res.status} with reason {res.reason} and message: {message}")
+
+    async def read_response(self, res: aiohttp.ClientResponse, return_type: str='JSON'):
+        if return_type == 'JSON':
+            res = await res.json(content_type=None)
         elif return_type == 'TEXT':
-            res = await res.text()
+            body = await res.read()
+            metrics_utils.record(bytes=len(body))
+            # DST starts csv bodies with a byte order mark, which would stick to the first column name.
+            # The streamed parser drops it with utf-8-sig
+            res = body.decode(res.get_encoding())
+            if res.startswith('\ufeff'):
+                res = res[1:]
         return res
 
+    async def close(self):
+        await self.session.close()
+        self.parse_executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+async def iterate_async(iterable):
+    for item in iterable:
+        yield item
+
+
+async def batch_lines(lines, batch_rows: int):
+    # splits the lines after the header into lists of at most batch_rows. Reading the response is interleaved
+    # with the consumer of the batches, so only the time spent waiting for lines counts as fetch
+    header = None
+    batch = []
+    batch_bytes = 0
+    ts = time.perf_counter()
+    async for line in lines:
+        if header is None:
+            header = line
+            continue
+        batch.append(line)
+        batch_bytes += len(line)
+        if len(batch) >= batch_rows:
+            metrics_utils.add('fetch', seconds=time.perf_counter() - ts, calls=1, bytes=batch_bytes)
+            yield header, batch
+            batch = []
+            batch_bytes = 0
+            ts = time.perf_counter()
+    if batch:
+        metrics_utils.add('fetch', seconds=time.perf_counter() - ts, calls=1, bytes=batch_bytes)
+        yield header, batch
+
+
+def parse_csv_batch(data: bytes, table_index: dict, col_names_dct: dict):
+    # module level, so a process pool can pickle it. Returns the timings and the memory of the process
+    # it ran in, since spans don't cross processes
+    start_rss_kb = metrics_utils.current_rss_kb()
+    ts = time.perf_counter()
+    df = pd.read_csv(BytesIO(data), sep=';', encoding='utf-8-sig', dtype=str)
+    parsed_rows = len(df)
+    parse_seconds = time.perf_counter() - ts
+    ts = time.perf_counter()
+    df = DST.format_table(df, table_index, col_names_dct)
+    validate_seconds = time.perf_counter() - ts
+    end_rss_kb = metrics_utils.current_rss_kb()
+    return df, parsed_rows, parse_seconds, validate_seconds, {'rss_kb': max(start_rss_kb, end_rss_kb), 'rss_growth_kb': max(end_rss_kb - start_rss_kb, 0)}
+
+
+async def copy_lines(lines, raw_file=None):
+    # passes the lines on, while writing them to raw_file when there is one
+    async for line in lines:
+        if raw_file:
+            raw_file.write(line)
+        yield line
+
+
 if __name__ == '__main__':
     dst = DST()
     self = dst
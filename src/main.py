@@ -1,69 +1,390 @@
 #%load_ext autoreload
 #%autoreload 2
 import pandas as pd
-import re
-from datetime import datetime, timedelta
 import asyncio
 import aiomysql
 import logging
 import glob
+import time
+import sys
+import json
+import hashlib
+import copy
 
-from utils import utils, sql_utils
+from utils import utils, sql_utils, time_utils, metrics_utils, lease_utils, aggregate_utils
+from utils.parquet_utils import ParquetSink
 from dst import DST
+import discovery
 import settings
 
 
-async def main():
-    logger = utils.get_logger('printyboi.log')
-    metadata_filelst = glob.glob(settings.METADATA_PATH.absolute().as_posix() + '/*.json')
-    dst = DST()
+async def ingest_table(metadata: dict, sync_state: dict, dst: DST, mysql_engine_pool: aiomysql.Pool, db_slots: asyncio.Semaphore, parquet_sink: ParquetSink=None):
+    table_name = f"input.dst_{metadata['table_id'].lower()}"
+    refresh = is_refresh(metadata)
+    metadata_hash = hash_metadata(metadata)
+    if settings.SKIP_UNCHANGED and is_unchanged(sync_state, metadata_hash):
+        logging.info(f"{metadata['table_id']} is unchanged since DST updated it {sync_state['dst_updated']}")
+        return {'status': 'unchanged', 'rows': 0, 'message': ''}
 
-    loop = asyncio.get_event_loop()
-    mysql_engine_pool = await sql_utils.async_mysql_create_engine(loop=loop, db_config=settings.MARIADB_CONFIG, db_name=settings.MARIADB_CONFIG['db'])
-    
-    for metadata_file in metadata_filelst:
-        logging.info(f'working on {metadata_file}')
-        metadata = utils.read_json(metadata_file)
-
-        if await sql_utils.table_exists_notempty(mysql_engine_pool, 'input', f"dst_{metadata['table_id'].lower()}"):
-            latest_date = await sql_utils.get_latest_date_in_table(mysql_engine_pool, f"input.dst_{metadata['table_id'].lower()}", date_col='time')
-            try:
-                latest_date = datetime.strptime(str(latest_date), '%Y')
-            except ValueError: # i don't have the quarters yet. So wont implement it yet
-                latest_date = datetime.strptime(str(latest_date), '%YM%m')
+    table_has_data = sync_state['has_data']
+    table_index, _ = await dst.get_table_index(metadata['table_id'])
+    granularity = time_utils.detect_granularity(table_index['Tid'].codes)
+    since = None
+    if table_has_data and not refresh:
+        # otherwise the Tid filter in the metadata decides the first period
+        latest_date = time_utils.to_datetime(sync_state['latest_date'])
+        # incremental fetches the latest periods again, so revisions from DST overwrite what we have
+        refetch_periods = metadata.get('refetch_periods', settings.REFETCH_PERIODS) if is_incremental(metadata) else 0
+        since = time_utils.refetch_start(latest_date, granularity, refetch_periods)
+        metadata['dst_variables']['Tid'] = [time_utils.time_filter(since, granularity)]
+
+    # a refresh loads into a staging table, that replaces the live table in one rename when it is complete
+    load_name = f'{table_name}__staging' if refresh else table_name
+    if refresh:
+        await sql_utils.drop_table(mysql_engine_pool, load_name)
+    if parquet_sink:
+        parquet_sink.begin(metadata['table_id'])
+
+    # parquet batches are staged, and only replace periods in the dataset once the load has succeeded
+    try:
+        if metadata.get('stream', False):
+            rows = await load_table_stream(metadata, dst, mysql_engine_pool, db_slots, load_name, parquet_sink)
         else:
-            latest_date = datetime.strptime('2015-01-01', '%Y-%m-%d')
-            # should then be used to change the call dynamically to this period
-        
-        #await dst.get_table_info("BEBRIT08")
-
-        time_end = re.search('(M|K)\d{1,2}', metadata['dst_variables']['Tid'][0])
-        if time_end:
-            metadata['dst_variables']['Tid'] = [f">{latest_date.year}M{latest_date.strftime('%m')}"]
+            rows = await load_table(metadata, dst, mysql_engine_pool, db_slots, load_name, parquet_sink)
+    except AssertionError as e:
+        logging.info(f'failed with {e}, if concerning Tid, then it is probably the stuff in prod')
+        if parquet_sink:
+            parquet_sink.abort(metadata['table_id'])
+        return {'status': 'skipped', 'rows': 0, 'message': str(e)}
+    except BaseException:
+        if parquet_sink:
+            parquet_sink.abort(metadata['table_id'])
+        raise
+
+    if refresh and rows:
+        async with db_slots:
+            with metrics_utils.span('swap'):
+                await sql_utils.swap_in_table(mysql_engine_pool, load_name, table_name, index_lst=metadata['index_vars'])
+    if parquet_sink:
+        # like the db, an empty load leaves the dataset alone
+        if rows:
+            parquet_sink.commit(metadata['table_id'], since)
         else:
-            metadata['dst_variables']['Tid'] = [f">{latest_date.year}"]
+            parquet_sink.abort(metadata['table_id'])
+    if metadata.get('aggregates') and rows:
+        async with db_slots:
+            with metrics_utils.span('aggregate'):
+                await aggregate_utils.refresh_aggregates(mysql_engine_pool, table_name, metadata['aggregates'], since)
+    if sync_state['dst_updated'] is not None:
+        await sql_utils.write_sync_ledger(mysql_engine_pool, settings.SYNC_LEDGER, metadata['table_id'], sync_state['dst_updated'], metadata_hash, rows)
+    return {'status': 'loaded', 'rows': rows, 'message': ''}
+
+
+async def load_table(metadata: dict, dst: DST, mysql_engine_pool: aiomysql.Pool, db_slots: asyncio.Semaphore, load_name: str, parquet_sink: ParquetSink=None):
+    df = await dst.get_table(metadata['table_id'], metadata['dst_variables'], params=data_params(metadata), request_type='GET', out_format=metadata['format'])
+    df['time'] = time_utils.parse_time_column(df['time'])
+
+    # NOT PIVOTING HERE, SINCE A BATCH MAY HOLD LESS THAN ONE VARIABLE. THEREFORE INDHOLD IS ALSO NOT CHANGED.
+    # PIVOTS AND ROLLUPS CONFIGURED UNDER 'aggregates' ARE MATERIALIZED IN THE DB AFTER THE LOAD, SEE aggregate_utils
+
+    async with db_slots:
+        with metrics_utils.span('create'):
+            await create_target_table(mysql_engine_pool, dst, df, load_name, metadata)
+        await write_table(mysql_engine_pool, df, load_name, load_mode=metadata.get('load_mode', 'INSERT'), upsert=is_incremental(metadata))
+    if parquet_sink:
+        await asyncio.get_event_loop().run_in_executor(None, parquet_sink.write, metadata['table_id'], df)
+    return len(df)
+
+
+async def load_table_stream(metadata: dict, dst: DST, mysql_engine_pool: aiomysql.Pool, db_slots: asyncio.Semaphore, load_name: str, parquet_sink: ParquetSink=None):
+    # fetching, parsing and writing run as overlapping stages that hand batches on through bounded queues.
+    # A slow stage holds back the ones before it instead of letting batches pile up, so memory stays
+    # around (queue sizes + workers) * batch size
+    raw_batches = asyncio.Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
+    frames = asyncio.Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
+    create_lock = asyncio.Lock()
+    state = {'created': False, 'rows': 0}
+
+    async def fetch():
+        async for raw_batch in dst.stream_raw_batches(metadata['table_id'], metadata['dst_variables'], params=data_params(metadata), request_type='GET', out_format=metadata['format'], batch_rows=settings.STREAM_BATCH_ROWS):
+            await raw_batches.put(raw_batch)
+        for _ in range(settings.PARSE_WORKERS):
+            await raw_batches.put(None)
+
+    async def parse():
+        while True:
+            raw_batch = await raw_batches.get()
+            if raw_batch is None:
+                return
+            df = await dst.parse_batch(*raw_batch)
+            df['time'] = time_utils.parse_time_column(df['time'])
+            await frames.put(df)
+
+    async def parse_all():
+        await asyncio.gather(*[parse() for _ in range(settings.PARSE_WORKERS)])
+        for _ in range(settings.PIPELINE_WRITERS):
+            await frames.put(None)
+
+    async def write():
+        while True:
+            df = await frames.get()
+            if df is None:
+                return
+            async with db_slots:
+                # the first frame decides the column types, the other writers wait for the table
+                async with create_lock:
+                    if not state['created']:
+                        with metrics_utils.span('create'):
+                            await create_target_table(mysql_engine_pool, dst, df, load_name, metadata)
+                        state['created'] = True
+                await write_table(mysql_engine_pool, df, load_name, load_mode=metadata.get('load_mode', 'INSERT'), upsert=is_incremental(metadata))
+            if parquet_sink:
+                await asyncio.get_event_loop().run_in_executor(None, parquet_sink.write, metadata['table_id'], df)
+            state['rows'] += len(df)
+
+    await run_stages([fetch(), parse_all()] + [write() for _ in range(settings.PIPELINE_WRITERS)])
+    return state['rows']
+
+
+async def run_stages(stages: list):
+    # a failing stage cancels the others, which would otherwise wait on their queues forever
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def is_incremental(metadata: dict):
+    return metadata.get('sync', settings.DEFAULT_SYNC) == 'incremental'
+
+
+def is_refresh(metadata: dict):
+    return metadata.get('sync', settings.DEFAULT_SYNC) == 'refresh'
+
+
+def hash_metadata(metadata: dict):
+    # a changed metadata file asks for other data, so it has to load even when DST has not published anything
+    return hashlib.sha256(json.dumps(metadata, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def is_unchanged(sync_state: dict, metadata_hash: str):
+    ledger_entry = sync_state['ledger']
+    return (sync_state['has_data'] and ledger_entry is not None and sync_state['dst_updated'] is not None
+            and ledger_entry['dst_updated'] == sync_state['dst_updated'] and ledger_entry['metadata_hash'] == metadata_hash)
+
+
+async def get_dst_updated(dst: DST, table_ids: list):
+    # without the catalog every table is loaded, as if it had changed
+    try:
+        updated = await dst.get_tables_updated(table_ids)
+    except Exception as e:
+        logging.warning(f'could not read table updates from the DST catalog: {e!r}')
+        return {}
+    return {table_id: pd.Timestamp(updated_str).to_pydatetime() for table_id, updated_str in updated.items()}
+
+
+def natural_key(df: pd.DataFrame):
+    # every dimension column plus time identifies a row, content is the only measure
+    return [col for col in list(df) if col != 'content']
 
+
+def is_code_storage(metadata: dict):
+    return metadata.get('storage', 'labels') == 'codes'
+
+
+def data_params(metadata: dict):
+    # code storage asks DST for code ids instead of labels
+    if is_code_storage(metadata):
+        return {'valuePresentation': 'Code'}
+    return None
+
+
+async def create_target_table(mysql_engine_pool: aiomysql.Pool, dst: DST, df: pd.DataFrame, load_name: str, metadata: dict):
+    dtype_trans_dct = sql_utils.get_dtype_trans(df)
+    if is_code_storage(metadata):
+        # the fact table keeps compact code ids, the labels live in a dimension table per variable
+        dimensions = await dst.get_dimensions(metadata['table_id'])
+        dimensions = {col: variable_index for col, variable_index in dimensions.items() if col in dtype_trans_dct}
+        dtype_trans_dct.update({col: sql_utils.code_sql_type(variable_index.codes) for col, variable_index in dimensions.items()})
+        await asyncio.gather(*[sql_utils.write_dimension_table(mysql_engine_pool, f"input.dst_{metadata['table_id'].lower()}_{col}", variable_index.codes, variable_index.labels) for col, variable_index in dimensions.items()])
+    unique_key = natural_key(df) if is_incremental(metadata) else None
+    # staging tables get their indexes after the load, which is much faster than maintaining them row by row
+    index_lst = None if is_refresh(metadata) else metadata['index_vars']
+    await sql_utils.create_table(mysql_engine_pool, load_name, col_datatype_dct=dtype_trans_dct, index_lst=index_lst, unique_key=unique_key)
+    if unique_key:
+        await sql_utils.ensure_unique_key(mysql_engine_pool, load_name, unique_key)
+
+
+async def write_table(mysql_engine_pool: aiomysql.Pool, df: pd.DataFrame, table_name: str, load_mode: str='INSERT', upsert: bool=False):
+    if load_mode not in ('INSERT', 'INFILE'):
+        raise ValueError(f'load_mode {load_mode} is not implemented, use INSERT or INFILE')
+    with metrics_utils.span('insert') as stage_metrics:
+        if load_mode == 'INFILE':
+            await sql_utils.df_to_sql_infile(mysql_engine_pool, df, table_name, replace=upsert)
+        else:
+            update_cols = ['content'] if upsert else None
+            await sql_utils.df_to_sql_split(mysql_engine_pool, df, table_name, chunksize=settings.INSERT_CHUNKSIZE, concurrency=settings.INSERT_CONCURRENCY, update_cols=update_cols)
+        stage_metrics.add(rows=len(df))
+
+
+async def run_table(metadata: dict, sync_state: dict, dst: DST, mysql_engine_pool: aiomysql.Pool, table_slots: asyncio.Semaphore, db_slots: asyncio.Semaphore, parquet_sink: ParquetSink=None):
+    async with table_slots:
+        logging.info(f"working on {metadata['table_id']}")
+        ts = time.time()
+        with metrics_utils.table_run(metadata['table_id']) as table_metrics:
+            try:
+                result = await ingest_table(metadata, sync_state, dst, mysql_engine_pool, db_slots, parquet_sink)
+            except Exception as e:
+                logging.exception(f"ingestion of {metadata['table_id']} failed")
+                result = {'status': 'failed', 'rows': 0, 'message': repr(e)}
+        result['table_id'] = metadata['table_id']
+        result['seconds'] = round(time.time() - ts, 2)
+        result['stages'] = table_metrics.to_dict()
+        return result
+
+
+def log_summary(results: list):
+    for result in results:
+        logging.info(f"{result['table_id']}: {result['status']} with {result['rows']} rows in {result['seconds']} s {result['message']}")
+        # one json line per table with the stage metrics, for log based dashboards
+        logging.info(json.dumps({'event': 'table_run', **result}))
+    statuses = [result['status'] for result in results]
+    logging.info(f"done with {len(results)} tables: {statuses.count('loaded')} loaded, {statuses.count('unchanged')} unchanged, {statuses.count('skipped')} skipped, {statuses.count('failed')} failed")
+
+
+async def keep_lease(mysql_engine_pool: aiomysql.Pool, table_id: str, job_task: asyncio.Task):
+    # renews the lease well before it expires, until the job is done and this task is cancelled. A lost lease
+    # may already have been claimed by another worker, so the job is cancelled rather than loading the table twice
+    while True:
+        await asyncio.sleep(settings.LEASE_SECONDS / 3)
         try:
-            df = await dst.get_table(metadata['table_id'], metadata['dst_variables'], request_type='GET', out_format=metadata['format'])
-        except AssertionError as e:
-            logging.info(f'failed with {e}, if concerning Tid, then it is probably the stuff in prod')
+            held = await lease_utils.heartbeat(mysql_engine_pool, settings.LEASE_TABLE, table_id, settings.WORKER_ID, settings.LEASE_SECONDS)
+        except Exception as e:
+            logging.warning(f'heartbeat for {table_id} failed with {e!r}')
             continue
+        if not held:
+            job_task.cancel()
+            return
+
 
-        if time_end:
-            df['time'] = pd.to_datetime(df['time'], format='%YM%m')
+async def run_leased(metadata_lst: list, sync_states: dict, dst: DST, mysql_engine_pool: aiomysql.Pool, table_slots: asyncio.Semaphore, db_slots: asyncio.Semaphore, parquet_sink: ParquetSink=None):
+    # claims jobs from the lease table until none are left. Other workers with the same RUN_ID do the same,
+    # and take over the jobs of a worker whose lease expires because it stopped sending heartbeats
+    metadata_dct = {metadata['table_id']: metadata for metadata in metadata_lst}
+    if not metadata_dct:
+        return []
+    await lease_utils.enqueue_jobs(mysql_engine_pool, settings.LEASE_TABLE, settings.RUN_ID, list(metadata_dct))
+    logging.info(f'{settings.WORKER_ID} is working on run {settings.RUN_ID}')
+    results = []
+
+    async def run_job(table_id: str):
+        # ingest_table changes the Tid filter, and a job may come back here for another attempt.
+        # Returns None when the lease was lost, the job then belongs to whoever claimed it next
+        metadata = copy.deepcopy(metadata_dct[table_id])
+        job_task = asyncio.ensure_future(run_table(metadata, sync_states[f"dst_{table_id.lower()}"], dst, mysql_engine_pool, table_slots, db_slots, parquet_sink))
+        heartbeat_task = asyncio.ensure_future(keep_lease(mysql_engine_pool, table_id, job_task))
+        try:
+            result = await job_task
+        except asyncio.CancelledError:
+            if heartbeat_task.done() and not heartbeat_task.cancelled():
+                logging.warning(f'stopped loading {table_id}, {settings.WORKER_ID} lost its lease')
+                return None
+            raise
+        finally:
+            heartbeat_task.cancel()
+            job_task.cancel()
+        await lease_utils.finish_job(mysql_engine_pool, settings.LEASE_TABLE, table_id, settings.WORKER_ID, result, settings.LEASE_MAX_ATTEMPTS)
+        return result
+
+    async def lease_loop():
+        # only jobs in this worker's metadata are claimed, other workers may have discovered other tables.
+        # A lease error is retried, a job that was claimed but not finished is picked up when its lease expires
+        errors = 0
+        while True:
+            try:
+                table_id = await lease_utils.claim_job(mysql_engine_pool, settings.LEASE_TABLE, settings.RUN_ID, settings.WORKER_ID, settings.LEASE_SECONDS, settings.LEASE_MAX_ATTEMPTS, list(metadata_dct))
+                if table_id is None:
+                    if not await lease_utils.count_open_jobs(mysql_engine_pool, settings.LEASE_TABLE, settings.RUN_ID, settings.LEASE_MAX_ATTEMPTS, list(metadata_dct)):
+                        return
+                    await asyncio.sleep(settings.LEASE_POLL_SECONDS)
+                    continue
+                result = await run_job(table_id)
+                if result is not None:
+                    results.append(result)
+                errors = 0
+            except Exception:
+                errors += 1
+                if errors >= settings.LEASE_MAX_ATTEMPTS:
+                    raise
+                logging.exception(f'{settings.WORKER_ID} failed on the lease table, retrying in {settings.LEASE_POLL_SECONDS} s')
+                await asyncio.sleep(settings.LEASE_POLL_SECONDS)
+
+    await asyncio.gather(*[lease_loop() for _ in range(settings.TABLE_CONCURRENCY)])
+    return results
+
+
+async def main(replay: bool=False, leased: bool=False, discover: bool=False):
+    logger = utils.get_logger('printyboi.log')
+    metadata_filelst = glob.glob(settings.METADATA_PATH.absolute().as_posix() + '/*.json')
+    loop = asyncio.get_event_loop()
+    # leased runs keep a connection per table free for the heartbeats
+    maxsize = settings.DB_WRITE_CONCURRENCY * settings.INSERT_CONCURRENCY + settings.TABLE_CONCURRENCY * (2 if leased else 1)
+    mysql_engine_pool = await sql_utils.async_mysql_create_engine(loop=loop, db_config=settings.MARIADB_CONFIG, db_name=settings.MARIADB_CONFIG['db'], maxsize=maxsize, local_infile=True)
+
+    # tables run concurrently, while http, parsing and db writes each have their own limit
+    table_slots = asyncio.Semaphore(settings.TABLE_CONCURRENCY)
+    db_slots = asyncio.Semaphore(settings.DB_WRITE_CONCURRENCY)
+    parquet_sink = ParquetSink(settings.PARQUET_PATH) if settings.PARQUET_PATH else None
+
+    # what is already loaded is probed for all tables at once, so scheduling decisions come from memory
+    metadata_lst = [utils.read_json(metadata_file) for metadata_file in metadata_filelst]
+    async with DST(replay=replay) as dst:
+        if discover:
+            # discovered tables are added to the metadata files, a file wins over a discovered job for the same table
+            jobs = await discovery.discover_jobs(dst, settings.DISCOVER_SUBJECTS, settings.DISCOVER_TABLE_PATTERN, settings.DISCOVER_PAST_DAYS)
+            configured = {metadata['table_id'].upper() for metadata in metadata_lst}
+            metadata_lst += [job for job in jobs if job['table_id'].upper() not in configured]
+        sync_states = await sql_utils.get_sync_state(mysql_engine_pool, 'input', [f"dst_{metadata['table_id'].lower()}" for metadata in metadata_lst])
+        ledger = await sql_utils.read_sync_ledger(mysql_engine_pool, settings.SYNC_LEDGER)
+        dst_updated = await get_dst_updated(dst, [metadata['table_id'] for metadata in metadata_lst])
+        for metadata in metadata_lst:
+            sync_state = sync_states[f"dst_{metadata['table_id'].lower()}"]
+            sync_state['dst_updated'] = dst_updated.get(metadata['table_id'].upper())
+            sync_state['ledger'] = ledger.get(metadata['table_id'])
+        if leased:
+            results = await run_leased(metadata_lst, sync_states, dst, mysql_engine_pool, table_slots, db_slots, parquet_sink)
         else:
-            df['time'] = pd.to_datetime(df['time'], format='%Y')
+            results = await asyncio.gather(*[run_table(metadata, sync_states[f"dst_{metadata['table_id'].lower()}"], dst, mysql_engine_pool, table_slots, db_slots, parquet_sink) for metadata in metadata_lst])
+    log_summary(results)
+    if settings.METRICS_PATH:
+        metrics_utils.write_prometheus(settings.METRICS_PATH, results)
 
-        # NOT PIVOTING OTHER THAN ON DEMAND, SINCE IT RELIES ON WHAT CAN BE INDEXED IN SINGLE DATASET, AND THAT MAY BE LESS THAN ONE VARIABLE
-        # THEREFORE INDHOLD IS ALSO NOT CHANGED
-        #cols = [col for col in list(df) if col not in [metadata['pivot_col'], 'INDHOLD']]
-        #df = pd.pivot(df, index=cols, columns=metadata['pivot_col'], values='People').reset_index()
+    mysql_engine_pool.close()
+    await mysql_engine_pool.wait_closed()
+    return results
 
-        dtype_trans_dct = sql_utils.get_dtype_trans(df)
-        await sql_utils.create_table(mysql_engine_pool, f"input.dst_{metadata['table_id'].lower()}", col_datatype_dct=dtype_trans_dct, index_lst=metadata['index_vars'])
-        await sql_utils.df_to_sql_split(mysql_engine_pool, df, f"input.dst_{metadata['table_id'].lower()}", chunksize=1000)
+
+async def warm_table_info():
+    # prefetches tableinfo for every metadata file into the cache
+    logger = utils.get_logger('printyboi.log')
+    metadata_filelst = glob.glob(settings.METADATA_PATH.absolute().as_posix() + '/*.json')
+    table_ids = [utils.read_json(metadata_file)['table_id'] for metadata_file in metadata_filelst]
+    async with DST() as dst:
+        await asyncio.gather(*[dst.get_table_info(table_id) for table_id in table_ids])
+    logging.info(f'warmed tableinfo cache for {len(table_ids)} tables')
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
-    #await main()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'warm':
+        asyncio.run(warm_table_info())
+    elif len(sys.argv) > 1 and sys.argv[1] == 'replay':
+        asyncio.run(main(replay=True))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        asyncio.run(main(leased=True, discover='discover' in sys.argv))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'discover':
+        asyncio.run(main(discover=True))
+    else:
+        asyncio.run(main())
+    #await main()
@@ -1,4 +1,6 @@
 import os
+import socket
+from datetime import date
 from pathlib import Path
 
 MARIADB_CONFIG = {
@@ -11,4 +13,69 @@ MARIADB_CONFIG = {
 
 METADATA_PATH = Path('tables')
 
-DST_BASE_URL = 'https://api.statbank.dk/v1'
\ No newline at end of file
+DST_BASE_URL = 'https://api.statbank.dk/v1'
+
+# concurrency limits for the ingestion scheduler
+TABLE_CONCURRENCY = int(os.environ.get('TABLE_CONCURRENCY', 4))
+DST_CONCURRENCY = int(os.environ.get('DST_CONCURRENCY', 4))
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', 2))
+DB_WRITE_CONCURRENCY = int(os.environ.get('DB_WRITE_CONCURRENCY', 4))
+INSERT_CHUNKSIZE = int(os.environ.get('INSERT_CHUNKSIZE', 5000))
+INSERT_CONCURRENCY = int(os.environ.get('INSERT_CONCURRENCY', 2))
+STREAM_BATCH_ROWS = int(os.environ.get('STREAM_BATCH_ROWS', 50000))
+# streamed tables run fetch, parse and write as overlapping stages with bounded queues between them.
+# PARSE_EXECUTOR is thread or process
+PARSE_EXECUTOR = os.environ.get('PARSE_EXECUTOR', 'thread')
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 2))
+PIPELINE_WRITERS = int(os.environ.get('PIPELINE_WRITERS', 2))
+
+CACHE_PATH = Path(os.environ.get('CACHE_PATH', 'cache'))
+TABLEINFO_TTL = int(os.environ.get('TABLEINFO_TTL', 7 * 24 * 3600))
+# keep raw data responses, so a run can be replayed with python main.py replay
+RAW_CACHE = os.environ.get('RAW_CACHE', '0') == '1'
+RAW_CACHE_COMPRESSLEVEL = int(os.environ.get('RAW_CACHE_COMPRESSLEVEL', 3))
+DST_CELL_LIMIT = int(os.environ.get('DST_CELL_LIMIT', 1000000))
+
+# DST transport
+DST_CONNECTION_LIMIT = int(os.environ.get('DST_CONNECTION_LIMIT', 20))
+DST_DNS_CACHE_TTL = int(os.environ.get('DST_DNS_CACHE_TTL', 300))
+DST_KEEPALIVE_TIMEOUT = float(os.environ.get('DST_KEEPALIVE_TIMEOUT', 30))
+DST_CONNECT_TIMEOUT = float(os.environ.get('DST_CONNECT_TIMEOUT', 10))
+DST_READ_TIMEOUT = float(os.environ.get('DST_READ_TIMEOUT', 300))
+DST_RATE_LIMIT = float(os.environ.get('DST_RATE_LIMIT', 10))
+DST_RATE_BURST = int(os.environ.get('DST_RATE_BURST', 10))
+DST_RETRIES = int(os.environ.get('DST_RETRIES', 5))
+DST_BACKOFF_BASE = float(os.environ.get('DST_BACKOFF_BASE', 0.5))
+DST_BACKOFF_CAP = float(os.environ.get('DST_BACKOFF_CAP', 30))
+
+# append only fetches periods after the latest one in the db. incremental, set per metadata file,
+# refetches the last REFETCH_PERIODS periods and upserts on the natural key
+DEFAULT_SYNC = os.environ.get('DEFAULT_SYNC', 'append')
+REFETCH_PERIODS = int(os.environ.get('REFETCH_PERIODS', 2))
+
+# tables DST has not republished since the last load are skipped, the ledger records what was loaded
+SKIP_UNCHANGED = os.environ.get('SKIP_UNCHANGED', '1') == '1'
+SYNC_LEDGER = os.environ.get('SYNC_LEDGER', 'input.dst_sync_ledger')
+
+# python main.py worker claims table jobs from the lease table, so several containers can share a run.
+# Workers with the same RUN_ID share the jobs, the default gives one run per day
+LEASE_TABLE = os.environ.get('LEASE_TABLE', 'input.dst_job_lease')
+RUN_ID = os.environ.get('RUN_ID', date.today().isoformat())
+WORKER_ID = os.environ.get('WORKER_ID', f'{socket.gethostname()}-{os.getpid()}')
+LEASE_SECONDS = int(os.environ.get('LEASE_SECONDS', 300))
+LEASE_POLL_SECONDS = float(os.environ.get('LEASE_POLL_SECONDS', 30))
+LEASE_MAX_ATTEMPTS = int(os.environ.get('LEASE_MAX_ATTEMPTS', 3))
+
+# python main.py discover adds every active table under DISCOVER_SUBJECTS (comma separated subject ids, default all)
+# whose id matches DISCOVER_TABLE_PATTERN, and that DST updated in the last DISCOVER_PAST_DAYS days when it is set
+DISCOVER_SUBJECTS = [subject_id for subject_id in os.environ.get('DISCOVER_SUBJECTS', '').split(',') if subject_id]
+DISCOVER_TABLE_PATTERN = os.environ.get('DISCOVER_TABLE_PATTERN') or None
+DISCOVER_PAST_DAYS = int(os.environ['DISCOVER_PAST_DAYS']) if os.environ.get('DISCOVER_PAST_DAYS') else None
+DISCOVER_INDEX_MIN_CODES = int(os.environ.get('DISCOVER_INDEX_MIN_CODES', 10))
+DISCOVER_MAX_INDEXES = int(os.environ.get('DISCOVER_MAX_INDEXES', 2))
+
+# parquet snapshots are written next to the db when a path is set
+PARQUET_PATH = Path(os.environ['PARQUET_PATH']) if os.environ.get('PARQUET_PATH') else None
+
+# per stage metrics of the last run are written here in the prometheus text format when a path is set
+METRICS_PATH = Path(os.environ['METRICS_PATH']) if os.environ.get('METRICS_PATH') else None
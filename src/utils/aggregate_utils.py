@@ -0,0 +1,91 @@
+import re
+import aiomysql
+import logging
+
+from utils import metrics_utils
+
+
+# summary tables configured in the metadata under 'aggregates', for example
+#   {"name": "by_region", "group_by": ["time", "region"]}                   rolls up the other dimensions
+#   {"name": "by_sex", "group_by": ["time", "region"], "pivot_col": "sex"}  one column per sex
+# are kept in input.dst_<id>__<name>. They are rebuilt for the periods from since on, so a load only
+# aggregates what it loaded. Without time in group_by, or without since, the whole table is rebuilt
+AGGREGATE_FUNCTIONS = ['SUM', 'AVG', 'MIN', 'MAX', 'COUNT']
+
+
+def aggregate_name(table_name: str, aggregate: dict):
+    return f"{table_name}__{aggregate['name']}"
+
+
+def pivot_column_name(pivot_col: str, value):
+    return f"{pivot_col}_{re.sub(r'[^0-9a-zA-Z]+', '_', str(value)).strip('_').lower()}"[:64]
+
+
+def aggregate_select(table_name: str, aggregate: dict, pivot_values: list=None, where: str='TRUE'):
+    # returns the SELECT, its args and the columns it gives
+    func = aggregate.get('agg', 'SUM').upper()
+    if func not in AGGREGATE_FUNCTIONS:
+        raise ValueError(f"agg {func} is not implemented, use one of {', '.join(AGGREGATE_FUNCTIONS)}")
+    group_by = aggregate['group_by']
+    pivot_col = aggregate.get('pivot_col')
+    if pivot_col:
+        measures = {pivot_column_name(pivot_col, value): f'{func}(CASE WHEN {pivot_col} = %s THEN content END)' for value in pivot_values}
+        args = list(pivot_values)
+    else:
+        measures = {'content': f'{func}(content)'}
+        args = []
+    measure_str = ', '.join([f'{expression} AS {col}' for col, expression in measures.items()])
+    sql_query = f"SELECT {', '.join(group_by)}, {measure_str} FROM {table_name} WHERE {where} GROUP BY {', '.join(group_by)}"
+    return sql_query, args, group_by + list(measures)
+
+
+async def refresh_aggregate(mysql_engine_pool: aiomysql.Pool, table_name: str, aggregate: dict, since=None):
+    agg_name = aggregate_name(table_name, aggregate)
+    pivot_col = aggregate.get('pivot_col')
+    incremental = since is not None and 'time' in aggregate['group_by']
+    conn = await mysql_engine_pool.acquire()
+    cur = await conn.cursor()
+    try:
+        pivot_values = None
+        if pivot_col:
+            await cur.execute(f'SELECT DISTINCT {pivot_col} FROM {table_name} WHERE {pivot_col} IS NOT NULL ORDER BY 1')
+            metrics_utils.record(db_round_trips=1)
+            pivot_values = [value for (value, ) in await cur.fetchall()]
+            if not pivot_values:
+                # no values means no measure columns, which isn't a table
+                logging.warning(f'{pivot_col} of {table_name} has no values, leaving {agg_name} alone')
+                return 0
+
+        # the table gets its column types from the select, and columns for pivot values that show up later
+        sql_query, args, columns = aggregate_select(table_name, aggregate, pivot_values, where='FALSE')
+        await cur.execute(f"CREATE TABLE IF NOT EXISTS {agg_name} (INDEX ({', '.join(aggregate['group_by'])})) AS {sql_query}", args)
+        metrics_utils.record(db_round_trips=1)
+        if pivot_col and pivot_values:
+            await cur.execute(f"ALTER TABLE {agg_name} {', '.join([f'ADD COLUMN IF NOT EXISTS {col} DOUBLE' for col in columns[len(aggregate['group_by']):]])}")
+            metrics_utils.record(db_round_trips=1)
+
+        # one transaction, so readers see the old or the new aggregate of the periods, never a gap
+        sql_query, args, columns = aggregate_select(table_name, aggregate, pivot_values, where='time >= %s' if incremental else 'TRUE')
+        await conn.begin()
+        if incremental:
+            await cur.execute(f'DELETE FROM {agg_name} WHERE time >= %s', (since, ))
+            await cur.execute(f"INSERT INTO {agg_name} ({', '.join(columns)}) {sql_query}", (*args, since))
+        else:
+            await cur.execute(f'DELETE FROM {agg_name}')
+            await cur.execute(f"INSERT INTO {agg_name} ({', '.join(columns)}) {sql_query}", args)
+        inserted_rows = cur.rowcount
+        await conn.commit()
+        metrics_utils.record(db_round_trips=3)
+    except Exception:
+        await conn.rollback()
+        raise
+    finally:
+        await cur.close()
+        await mysql_engine_pool.release(conn)
+    logging.info(f"refreshed {inserted_rows} rows in {agg_name}{f' from {since:%Y-%m-%d}' if incremental else ''}")
+    return inserted_rows
+
+
+async def refresh_aggregates(mysql_engine_pool: aiomysql.Pool, table_name: str, aggregates: list, since=None):
+    for aggregate in aggregates:
+        await refresh_aggregate(mysql_engine_pool, table_name, aggregate, since)
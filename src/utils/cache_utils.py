@@ -0,0 +1,199 @@
+import json
+import time
+import logging
+import gzip
+import hashlib
+import mmap
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+import pyarrow as pa
+
+
+class TableInfoCache():
+    """Two level cache for DST tableinfo responses
+
+    An in-process LRU in front of json files on disk, keyed by table id and language.
+    Entries keep the ETag and Last-Modified headers, so stale entries can be revalidated
+    with a conditional request instead of being downloaded again.
+
+    Arguments
+    ---------
+    cache_path: folder for the json files
+    ttl: seconds an entry is used without asking DST
+    maxsize: number of entries held in memory
+    """
+    def __init__(self, cache_path: Path, ttl: int, maxsize: int=128):
+        self.cache_path = Path(cache_path)
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.memory = OrderedDict()
+
+    def file_path(self, table_id: str, lang: str):
+        return self.cache_path / f"{table_id.upper()}_{lang}.json"
+
+    def get(self, table_id: str, lang: str):
+        key = (table_id.upper(), lang)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        file_path = self.file_path(table_id, lang)
+        if not file_path.exists():
+            return None
+        try:
+            with open(file_path) as json_file:
+                entry = json.load(json_file)
+        except ValueError:
+            logging.warning(f'corrupt tableinfo cache file {file_path}, ignoring it')
+            return None
+        self.remember(key, entry)
+        return entry
+
+    def put(self, table_id: str, lang: str, variables: list, etag: str=None, last_modified: str=None):
+        entry = {
+            'fetched_at': time.time(),
+            'etag': etag,
+            'last_modified': last_modified,
+            'variables': variables,
+        }
+        # write to a temp file first, so concurrent readers never see half a file
+        file_path = self.file_path(table_id, lang)
+        tmp_path = file_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        tmp_path.replace(file_path)
+        self.remember((table_id.upper(), lang), entry)
+        return entry
+
+    def touch(self, table_id: str, lang: str, entry: dict):
+        return self.put(table_id, lang, entry['variables'], entry.get('etag'), entry.get('last_modified'))
+
+    def remember(self, key: tuple, entry: dict):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def is_fresh(self, entry: dict):
+        return time.time() - entry['fetched_at'] < self.ttl
+
+    @staticmethod
+    def revalidation_headers(entry: dict):
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+
+class RawResponseCache():
+    """Content addressed store of raw DST data responses
+
+    Bodies are gzipped files named by a hash of the table id, format and the
+    normalized request, so the same request always maps to the same file.
+    Reads go through a memory map, so replaying a large extract doesn't copy
+    the compressed file into memory first. A manifest per table records the
+    requests of its last fully cached fetch, which is what a replay repeats.
+    """
+    def __init__(self, cache_path: Path, compresslevel: int=3):
+        self.cache_path = Path(cache_path)
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        self.compresslevel = compresslevel
+
+    @staticmethod
+    def key(table_id: str, out_format: str, url: str, payload: dict):
+        request = json.dumps({'table_id': table_id.upper(), 'format': out_format, 'url': url, 'payload': payload}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def file_path(self, key: str):
+        return self.cache_path / f'{key}.csv.gz'
+
+    def write(self, key: str, body: bytes):
+        with self.writer(key) as raw_file:
+            raw_file.write(body)
+
+    def read(self, key: str):
+        with self.open(key) as raw_file:
+            return raw_file.read()
+
+    @contextmanager
+    def writer(self, key: str):
+        # the file only appears under its key once the whole body is written
+        file_path = self.file_path(key)
+        tmp_path = file_path.with_suffix('.tmp')
+        try:
+            with gzip.open(tmp_path, 'wb', compresslevel=self.compresslevel) as raw_file:
+                yield raw_file
+            tmp_path.replace(file_path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    @contextmanager
+    def open(self, key: str):
+        file_path = self.file_path(key)
+        if not file_path.exists():
+            raise FileNotFoundError(f'no cached response {key}, the request has to run online first')
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, gzip.GzipFile(fileobj=mapped) as raw_file:
+            yield raw_file
+
+    def manifest_path(self, table_id: str):
+        return self.cache_path / f'{table_id.upper()}.manifest.json'
+
+    def write_manifest(self, table_id: str, requests: list):
+        # written once every response of the fetch is cached, so a manifest never points at a missing file
+        manifest_path = self.manifest_path(table_id)
+        tmp_path = manifest_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'written_at': time.time(), 'requests': requests}, f, ensure_ascii=False)
+        tmp_path.replace(manifest_path)
+
+    def read_manifest(self, table_id: str):
+        manifest_path = self.manifest_path(table_id)
+        if not manifest_path.exists():
+            raise FileNotFoundError(f'no cached fetch of {table_id}, it has to run online first')
+        with open(manifest_path) as f:
+            return json.load(f)['requests']
+
+
+class ResultCache():
+    """Arrow IPC files of query results
+
+    Files are named by a hash of the query, its args and the watermark of the
+    table it reads, so a result is reused until the table changes. Reads go
+    through a memory map, so a cached result costs no copy until it is used.
+    """
+    def __init__(self, cache_path: Path):
+        self.cache_path = Path(cache_path)
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(sql_query: str, args: list, watermark: str):
+        query = json.dumps({'query': sql_query, 'args': args, 'watermark': watermark}, sort_keys=True, default=str)
+        return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+    def file_path(self, key: str):
+        return self.cache_path / f'{key}.arrow'
+
+    def exists(self, key: str):
+        return self.file_path(key).exists()
+
+    @contextmanager
+    def writer(self, key: str, schema: pa.Schema):
+        # the file only appears under its key once every batch is written, so an abandoned read caches nothing
+        file_path = self.file_path(key)
+        tmp_path = file_path.with_suffix('.tmp')
+        try:
+            with pa.OSFile(str(tmp_path), 'wb') as sink, pa.ipc.new_file(sink, schema) as batch_writer:
+                yield batch_writer
+            tmp_path.replace(file_path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    @contextmanager
+    def open(self, key: str):
+        with pa.memory_map(str(self.file_path(key)), 'r') as source:
+            yield pa.ipc.open_file(source)
@@ -0,0 +1,101 @@
+from bisect import bisect_left, bisect_right
+from fnmatch import fnmatchcase
+from math import prod
+from typing import List, Dict
+import operator
+
+from utils import utils
+
+
+class VariableIndex():
+    """Lookup structure for the code ids of one tableinfo variable
+
+    Membership is a set lookup, and operator filters like '>100' are a bisect
+    into the numeric codes kept in sorted order. The labels and codes of total
+    values, the ones DST labels '..., total', are kept, so total rows can be
+    found without scanning the data.
+    """
+    def __init__(self, codes: List[str], labels: List[str]=None):
+        self.codes = codes
+        self.code_set = frozenset(codes)
+        self.labels = labels or []
+        self.total_labels = frozenset(label for label in self.labels if ', total' in label)
+        self.total_codes = frozenset(code for code, label in zip(codes, self.labels) if ', total' in label)
+        numeric = sorted((float(code), code) for code in codes if utils.is_number(code))
+        self.numeric_values = [value for value, _ in numeric]
+        self.numeric_codes = [code for _, code in numeric]
+
+    def __contains__(self, code: str):
+        return code in self.code_set
+
+    def __len__(self):
+        return len(self.codes)
+
+    def missing(self, values: List[str]):
+        return [value for value in values if value not in self.code_set]
+
+    def match(self, expression: str):
+        operator, value = utils.parse_operator_value(expression)
+        if operator == '>':
+            return self.numeric_codes[bisect_right(self.numeric_values, value):]
+        elif operator == '>=':
+            return self.numeric_codes[bisect_left(self.numeric_values, value):]
+        elif operator == '<':
+            return self.numeric_codes[:bisect_left(self.numeric_values, value)]
+        elif operator == '<=':
+            return self.numeric_codes[:bisect_right(self.numeric_values, value)]
+        return self.numeric_codes[bisect_left(self.numeric_values, value):bisect_right(self.numeric_values, value)]
+
+    def match_ordered(self, expression: str):
+        # for codes that only compare as strings, like the time codes 2015M01 or 2015K1
+        string_operator, value = utils.parse_operator(expression)
+        compare = STRING_OPERATORS[string_operator]
+        return [code for code in self.codes if compare(code, value)]
+
+    def resolve(self, values: List[str]):
+        # expands wildcards and operators into the explicit code ids the request covers
+        if len(values) == 1 and '*' in values[0]:
+            return [code for code in self.codes if fnmatchcase(code, values[0])]
+        if len(values) == 1 and utils.parse_operator_value(values[0]):
+            return self.match(values[0])
+        if len(values) == 1 and utils.parse_operator(values[0]):
+            return self.match_ordered(values[0])
+        return list(values)
+
+
+STRING_OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '=': operator.eq,
+    '==': operator.eq,
+}
+
+
+def build_table_index(variables_dct: Dict[str, List[str]], labels_dct: Dict[str, List[str]]=None):
+    labels_dct = labels_dct or {}
+    return {variable_id: VariableIndex(codes, labels_dct.get(variable_id)) for variable_id, codes in variables_dct.items()}
+
+
+def split_request(variables: Dict[str, List[str]], cell_limit: int):
+    """Splits resolved request variables into sub requests of at most cell_limit cells
+
+    Tid is split first, since periods are independent and grow over time,
+    otherwise the variable with the most codes. Splitting recurses when a
+    single code of the chosen variable is still over the limit.
+    """
+    cells = prod(len(codes) for codes in variables.values())
+    splittable = [key for key, codes in variables.items() if len(codes) > 1]
+    if cells <= cell_limit or not splittable:
+        return [variables]
+    if 'Tid' in splittable:
+        key = 'Tid'
+    else:
+        key = max(splittable, key=lambda key: len(variables[key]))
+    cells_per_code = cells // len(variables[key])
+    chunk_size = max(1, cell_limit // cells_per_code)
+    sub_requests = []
+    for chunk in utils.split_list(variables[key], chunk_size):
+        sub_requests.extend(split_request({**variables, key: chunk}, cell_limit))
+    return sub_requests
@@ -0,0 +1,111 @@
+import aiomysql
+import logging
+
+from utils import sql_utils
+
+
+# one row per table job. Workers claim pending jobs, or jobs whose lease has expired because their
+# worker stopped sending heartbeats, with SELECT ... FOR UPDATE SKIP LOCKED (MariaDB 10.6 or later),
+# so concurrent workers never block on or claim the same row
+LEASE_COLUMNS = {
+    'table_id': 'VARCHAR(32) PRIMARY KEY',
+    'run_id': 'VARCHAR(64)',
+    'status': 'VARCHAR(16)',
+    'worker_id': 'VARCHAR(64)',
+    'leased_until': 'DATETIME',
+    'attempts': 'INT',
+    'result_status': 'VARCHAR(16)',
+    'result_rows': 'INT',
+    'result_seconds': 'FLOAT',
+    'message': 'TEXT',
+    'finished_at': 'DATETIME',
+}
+
+
+async def enqueue_jobs(mysql_engine_pool: aiomysql.Pool, lease_name: str, run_id: str, table_ids: list):
+    # every worker of a run enqueues the same jobs, so whoever starts first creates them. A new run_id resets the
+    # jobs of the previous run. run_id is assigned last, since MariaDB evaluates the assignments in order
+    await sql_utils.create_table(mysql_engine_pool, lease_name, col_datatype_dct=LEASE_COLUMNS, index_lst=['run_id, status'])
+    sql_query = f"""
+    INSERT INTO {lease_name} (table_id, run_id, status, attempts) VALUES (%s, %s, 'pending', 0)
+    ON DUPLICATE KEY UPDATE
+        status = IF(run_id = VALUES(run_id), status, 'pending'),
+        attempts = IF(run_id = VALUES(run_id), attempts, 0),
+        result_status = IF(run_id = VALUES(run_id), result_status, NULL),
+        run_id = VALUES(run_id)
+    """
+    conn = await mysql_engine_pool.acquire()
+    cur = await conn.cursor()
+    await cur.executemany(sql_query, [(table_id, run_id) for table_id in table_ids])
+    await cur.close()
+    await mysql_engine_pool.release(conn)
+
+
+async def claim_job(mysql_engine_pool: aiomysql.Pool, lease_name: str, run_id: str, worker_id: str, lease_seconds: int, max_attempts: int, table_ids: list):
+    # returns the claimed table_id, None when none of table_ids is claimable right now
+    conn = await mysql_engine_pool.acquire()
+    cur = await conn.cursor()
+    try:
+        await conn.begin()
+        await cur.execute(f"""
+        SELECT table_id FROM {lease_name}
+        WHERE run_id = %s AND attempts < %s AND (status = 'pending' OR (status = 'leased' AND leased_until < NOW()))
+        AND table_id IN ({','.join(['%s'] * len(table_ids))})
+        ORDER BY attempts, table_id LIMIT 1
+        FOR UPDATE SKIP LOCKED
+        """, (run_id, max_attempts, *table_ids))
+        row = await cur.fetchone()
+        if row:
+            await cur.execute(f"""
+            UPDATE {lease_name} SET status = 'leased', worker_id = %s, leased_until = NOW() + INTERVAL %s SECOND, attempts = attempts + 1
+            WHERE table_id = %s
+            """, (worker_id, lease_seconds, row[0]))
+        await conn.commit()
+    except Exception:
+        await conn.rollback()
+        raise
+    finally:
+        await cur.close()
+        await mysql_engine_pool.release(conn)
+    return row[0] if row else None
+
+
+async def heartbeat(mysql_engine_pool: aiomysql.Pool, lease_name: str, table_id: str, worker_id: str, lease_seconds: int):
+    # extends the lease, returns False when it was lost to another worker after it expired
+    conn = await mysql_engine_pool.acquire()
+    cur = await conn.cursor()
+    await cur.execute(f"""
+    UPDATE {lease_name} SET leased_until = NOW() + INTERVAL %s SECOND
+    WHERE table_id = %s AND worker_id = %s AND status = 'leased'
+    """, (lease_seconds, table_id, worker_id))
+    updated_rows = cur.rowcount
+    await cur.close()
+    await mysql_engine_pool.release(conn)
+    if not updated_rows:
+        logging.warning(f'{worker_id} lost the lease on {table_id}')
+    return bool(updated_rows)
+
+
+async def finish_job(mysql_engine_pool: aiomysql.Pool, lease_name: str, table_id: str, worker_id: str, result: dict, max_attempts: int):
+    # failed jobs go back to pending until they have used max_attempts
+    conn = await mysql_engine_pool.acquire()
+    cur = await conn.cursor()
+    await cur.execute(f"""
+    UPDATE {lease_name}
+    SET status = IF(%s = 'failed' AND attempts < %s, 'pending', 'done'), leased_until = NULL,
+        result_status = %s, result_rows = %s, result_seconds = %s, message = %s, finished_at = NOW()
+    WHERE table_id = %s AND worker_id = %s
+    """, (result['status'], max_attempts, result['status'], result['rows'], result['seconds'], result['message'][:10000], table_id, worker_id))
+    await cur.close()
+    await mysql_engine_pool.release(conn)
+
+
+async def count_open_jobs(mysql_engine_pool: aiomysql.Pool, lease_name: str, run_id: str, max_attempts: int, table_ids: list):
+    # jobs of table_ids that are pending or leased, including leases held by other workers that may still expire
+    conn = await mysql_engine_pool.acquire()
+    cur = await conn.cursor()
+    await cur.execute(f"SELECT COUNT(1) FROM {lease_name} WHERE run_id = %s AND attempts < %s AND status IN ('pending', 'leased') AND table_id IN ({','.join(['%s'] * len(table_ids))})", (run_id, max_attempts, *table_ids))
+    (open_num, ) = await cur.fetchone()
+    await cur.close()
+    await mysql_engine_pool.release(conn)
+    return open_num
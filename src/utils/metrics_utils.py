@@ -0,0 +1,136 @@
+import os
+import time
+import resource
+from pathlib import Path
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# the table run and the open span follow the task, so concurrent tables and the tasks
+# they gather (http parts, insert chunks) record into their own table without passing it around
+_current_run = ContextVar('current_run', default=None)
+_current_stage = ContextVar('current_stage', default=None)
+
+STAGE_FIELDS = ['seconds', 'calls', 'bytes', 'rows', 'db_round_trips', 'rss_kb', 'rss_growth_kb']
+# the largest value of these is kept, the other fields add up
+MAX_FIELDS = ['rss_kb', 'rss_growth_kb']
+PAGE_KB = os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+class StageMetrics():
+    """Totals for one stage of a table run, seconds add up over every span of the stage
+
+    rss_kb is the largest resident memory of the process seen as a span of the stage
+    started or ended, and rss_growth_kb the most it grew over one span. Unlike the
+    high water mark of the process, these go down again, so a stage is not charged
+    for the memory of an earlier stage or another table.
+    """
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.bytes = 0
+        self.rows = 0
+        self.db_round_trips = 0
+        self.rss_kb = 0
+        self.rss_growth_kb = 0
+
+    def add(self, **counts):
+        for field, value in counts.items():
+            if field in MAX_FIELDS:
+                setattr(self, field, max(getattr(self, field), value))
+            else:
+                setattr(self, field, getattr(self, field) + value)
+
+    def to_dict(self):
+        dct = {field: getattr(self, field) for field in STAGE_FIELDS}
+        dct['seconds'] = round(dct['seconds'], 4)
+        return dct
+
+
+class TableRun():
+    def __init__(self, table_id: str):
+        self.table_id = table_id
+        self.stages = {}
+
+    def stage(self, name: str):
+        if name not in self.stages:
+            self.stages[name] = StageMetrics()
+        return self.stages[name]
+
+    def to_dict(self):
+        return {name: stage_metrics.to_dict() for name, stage_metrics in self.stages.items()}
+
+
+def current_rss_kb():
+    # resident memory of the process right now. Without /proc the high water mark is the best there is
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_KB
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+@contextmanager
+def table_run(table_id: str):
+    run = TableRun(table_id)
+    token = _current_run.set(run)
+    try:
+        yield run
+    finally:
+        _current_run.reset(token)
+
+
+@contextmanager
+def span(stage: str):
+    # times a stage of the current table run, outside a run the metrics are just dropped
+    run = _current_run.get()
+    stage_metrics = run.stage(stage) if run else StageMetrics()
+    token = _current_stage.set(stage_metrics)
+    start_rss_kb = current_rss_kb()
+    ts = time.perf_counter()
+    try:
+        yield stage_metrics
+    finally:
+        end_rss_kb = current_rss_kb()
+        stage_metrics.add(seconds=time.perf_counter() - ts, calls=1, rss_kb=max(start_rss_kb, end_rss_kb), rss_growth_kb=max(end_rss_kb - start_rss_kb, 0))
+        _current_stage.reset(token)
+
+
+def record(**counts):
+    # adds counts like rows=... or db_round_trips=1 to the innermost open span
+    stage_metrics = _current_stage.get()
+    if stage_metrics is not None:
+        stage_metrics.add(**counts)
+
+
+def add(stage: str, **counts):
+    # adds to a stage of the current table run without a span, for work that is
+    # interleaved with other stages, like reading a streamed response between batches.
+    # Work done in another process passes its own rss_kb and rss_growth_kb, this process is always recorded
+    run = _current_run.get()
+    if run is not None:
+        run.stage(stage).add(**counts)
+        run.stage(stage).add(rss_kb=current_rss_kb())
+
+
+def prometheus_text(results: list):
+    lines = []
+    for field in STAGE_FIELDS:
+        lines.append(f'# TYPE dst_stage_{field} gauge')
+        for result in results:
+            for stage, stage_metrics in result.get('stages', {}).items():
+                lines.append(f"dst_stage_{field}{{table_id=\"{result['table_id']}\",stage=\"{stage}\"}} {stage_metrics[field]}")
+    lines.append('# TYPE dst_table_seconds gauge')
+    lines += [f"dst_table_seconds{{table_id=\"{result['table_id']}\",status=\"{result['status']}\"}} {result['seconds']}" for result in results]
+    lines.append('# TYPE dst_table_rows gauge')
+    lines += [f"dst_table_rows{{table_id=\"{result['table_id']}\",status=\"{result['status']}\"}} {result['rows']}" for result in results]
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(metrics_path: Path, results: list):
+    # written for the node exporter textfile collector, which must never see a half written file
+    metrics_path = Path(metrics_path)
+    metrics_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = metrics_path.with_name(metrics_path.name + '.tmp')
+    tmp_path.write_text(prometheus_text(results))
+    os.replace(tmp_path, metrics_path)
@@ -0,0 +1,61 @@
+import shutil
+import uuid
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class ParquetSink():
+    """Writes ingested tables as parquet datasets partitioned by time
+
+    Every table is a folder dst_<table> with a time=YYYY-MM-DD folder per period.
+    A load writes its batches into a staging folder under .staging, and only when
+    the load has succeeded, commit drops the live periods after since, the same
+    periods the db gets from the Tid filter, and moves the staged periods in. So
+    revised periods are replaced, older periods are left alone, and a failed load
+    leaves the dataset as it was.
+    """
+    def __init__(self, root_path: Path):
+        self.root_path = Path(root_path)
+
+    def dataset_path(self, table_id: str):
+        return self.root_path / f'dst_{table_id.lower()}'
+
+    def staging_path(self, table_id: str):
+        # pyarrow dataset discovery skips folders starting with a dot
+        return self.root_path / '.staging' / f'dst_{table_id.lower()}'
+
+    def begin(self, table_id: str):
+        # clears what an earlier load that never committed left in staging
+        self.abort(table_id)
+
+    def abort(self, table_id: str):
+        shutil.rmtree(self.staging_path(table_id), ignore_errors=True)
+
+    def commit(self, table_id: str, since: datetime=None):
+        # drops the live partitions after since, or every partition for a full load, and moves the staged ones in
+        dataset_path = self.dataset_path(table_id)
+        staging_path = self.staging_path(table_id)
+        dataset_path.mkdir(parents=True, exist_ok=True)
+        for partition_path in dataset_path.glob('time=*'):
+            if since is None or datetime.fromisoformat(partition_path.name[len('time='):]) > since:
+                shutil.rmtree(partition_path)
+        for partition_path in staging_path.glob('time=*'):
+            live_path = dataset_path / partition_path.name
+            if live_path.exists():
+                shutil.rmtree(live_path)
+            partition_path.rename(live_path)
+        self.abort(table_id)
+
+    def write(self, table_id: str, df: pd.DataFrame):
+        # categories become dictionary encoded columns in arrow and stay dictionary encoded in parquet
+        df = df.assign(time=df['time'].dt.strftime('%Y-%m-%d'))
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_to_dataset(table,
+                            root_path=self.staging_path(table_id).as_posix(),
+                            partition_cols=['time'],
+                            basename_template=f'{uuid.uuid4().hex}-{{i}}.parquet',
+                            use_dictionary=True,
+                            compression='snappy')
@@ -1,7 +1,6 @@
 import sqlalchemy
 import pandas as pd
 import os
-from tqdm import tqdm
 import sys
 from sqlalchemy.types import String, Integer, Numeric
 from typing import List, Dict
@@ -10,8 +9,16 @@ import logging
 import re
 import aiomysql
 import asyncio
-
-from utils import utils
+import time
+import tempfile
+import uuid
+from functools import partial
+from contextlib import nullcontext
+import pyarrow as pa
+from datetime import datetime
+
+from utils import utils, metrics_utils
+from utils.cache_utils import ResultCache
 import settings
 
 
@@ -50,7 +57,7 @@ def create_engine(db_config: dict, db_name: str=None, db_type: str='postgres', *
     engine = sqlalchemy.create_engine(conn_string, **kwargs)
     return engine
 
-async def async_mysql_create_engine(loop, db_config: dict, db_name: str=None):
+async def async_mysql_create_engine(loop, db_config: dict, db_name: str=None, maxsize: int=10, local_infile: bool=False):
     uid, psw, host, port, db = db_config.values()
     if db_name:
        db = db_name
@@ -60,11 +67,13 @@ async def async_mysql_create_engine(loop, db_config: dict, db_name: str=None):
                                       port=port,
                                       password=psw,
                                       loop=loop,
+                                      maxsize=maxsize,
+                                      local_infile=local_infile,
                                       autocommit=True)
     return pool
 
 
-async def create_table(mysql_engine_pool: aiomysql.Pool, table_name: str, col_datatype_dct: dict, primary_key: str=None, index_lst: list=None, foreignkey_ref_dct: dict=None):
+async def create_table(mysql_engine_pool: aiomysql.Pool, table_name: str, col_datatype_dct: dict, primary_key: str=None, index_lst: list=None, foreignkey_ref_dct: dict=None, unique_key: list=None):
     #primary_key = "id INT AUTO_INCREMENT PRIMARY KEY"
     def_strings = []
     col_definition_str =  ', '.join([f"{k} {v}" for k, v in col_datatype_dct.items()])
@@ -78,37 +87,117 @@ async def create_table(mysql_engine_pool: aiomysql.Pool, table_name: str, col_da
     if index_lst:
         index_str = ", ".join([f'INDEX ({index})' for index in index_lst])
         def_strings.append(index_str)
+    if unique_key:
+        def_strings.append(natural_key_definition(unique_key))
 
     create_table_query = f"""CREATE TABLE IF NOT EXISTS {table_name} ({','.join(def_strings)});"""
 
     conn = await mysql_engine_pool.acquire()
     cur = await conn.cursor()
     await cur.execute(create_table_query)    
+    metrics_utils.record(db_round_trips=1)
     await cur.close()
     await mysql_engine_pool.release(conn)
 
-async def df_to_sql_split(mysql_engine_pool: aiomysql.Pool, df: pd.DataFrame, table_name: str, chunksize: int=50):
-    for i in range(0, len(df), chunksize):
-        await df_to_sql(mysql_engine_pool, df.iloc[i:i+chunksize],table_name)
+def natural_key_hash(unique_key: list):
+    # CHAR(31) separates the values, so ('a b', 'c') and ('a', 'b c') hash differently. CONCAT_WS skips NULLs,
+    # so they become CHAR(0) first, or (NULL, 'x') and ('x', NULL) would hash the same
+    return f"UNHEX(SHA2(CONCAT_WS(CHAR(31), {', '.join([f'IFNULL({col}, CHAR(0))' for col in unique_key])}), 256))"
 
-async def df_to_sql(mysql_engine_pool: aiomysql.Pool, df: pd.DataFrame, table_name: str):
-    def delete_quotation(str: str):
-        return str.replace("'","").replace('"','')
+def natural_key_definition(unique_key: list):
+    # the key is a persistent 32 byte hash of the columns. A key on the columns themselves passes InnoDB's
+    # 3072 byte limit with a handful of utf8mb4 VARCHAR(150) dimensions. Inserts leave the column out, the server fills it
+    return f"natural_key_hash BINARY(32) AS ({natural_key_hash(unique_key)}) PERSISTENT, UNIQUE KEY natural_key (natural_key_hash)"
+
+async def ensure_unique_key(mysql_engine_pool: aiomysql.Pool, table_name: str, unique_key: list):
+    # adds the natural key to tables created before it existed. ALTER IGNORE drops the duplicates earlier
+    # reruns left behind, and how many it drops is logged first
+    schema_name, table = table_name.split('.')
+    conn = await mysql_engine_pool.acquire()
+    cur = await conn.cursor()
+    await cur.execute(f"SELECT COUNT(1) FROM INFORMATION_SCHEMA.STATISTICS WHERE table_schema='{schema_name}' AND table_name='{table}' AND index_name='natural_key'")
+    metrics_utils.record(db_round_trips=1)
+    (index_exists_num, ) = await cur.fetchone()
+    if index_exists_num == 0:
+        await cur.execute(f"SELECT COUNT(1) - COUNT(DISTINCT {natural_key_hash(unique_key)}) FROM {table_name}")
+        (duplicate_num, ) = await cur.fetchone()
+        if duplicate_num:
+            logging.warning(f'{table_name} has {duplicate_num} duplicate rows on ({", ".join(unique_key)}), adding the natural key removes them')
+        logging.info(f'adding natural key ({", ".join(unique_key)}) to {table_name}')
+        await cur.execute(f"ALTER IGNORE TABLE {table_name} ADD COLUMN natural_key_hash BINARY(32) AS ({natural_key_hash(unique_key)}) PERSISTENT, ADD UNIQUE KEY natural_key (natural_key_hash)")
+        metrics_utils.record(db_round_trips=2)
+    await cur.close()
+    await mysql_engine_pool.release(conn)
+
+async def df_to_sql_split(mysql_engine_pool: aiomysql.Pool, df: pd.DataFrame, table_name: str, chunksize: int=50, concurrency: int=1, update_cols: list=None):
+    # values are converted once for the whole frame, and chunks are sent over several pool connections at once
+    ts = time.time()
+    columns = list(df)
+    # building the records is cpu bound, so it runs off the event loop
+    records = await asyncio.get_event_loop().run_in_executor(None, df_to_records, df)
+    chunk_slots = asyncio.Semaphore(concurrency)
 
-    df = df.astype(str)
-    df_values = [[delete_quotation(value) for value in values] for values in df.values]
-    sql_query_start = f'INSERT INTO {table_name}'
-    column_str = ','.join(list(df))
-    values_str = ','.join([f'''('{"','".join(values)}')''' for values in df_values])
-    values_str = utils.multiple_replace({"'nan'": 'NULL', "'<NA>'": 'NULL'}, values_str)
+    async def write_chunk(chunk: list):
+        async with chunk_slots:
+            await records_to_sql(mysql_engine_pool, chunk, columns, table_name, update_cols=update_cols)
 
-    sql_query = f"{sql_query_start} ({column_str}) VALUES {values_str}"
+    await asyncio.gather(*[write_chunk(records[i:i+chunksize]) for i in range(0, len(records), chunksize)])
+    seconds = time.time() - ts
+    logging.info(f'inserted {len(records)} rows into {table_name} in {seconds:.2f} s ({len(records) / max(seconds, 1e-6):.0f} rows/s)')
+    return len(records)
+
+async def df_to_sql(mysql_engine_pool: aiomysql.Pool, df: pd.DataFrame, table_name: str):
+    await records_to_sql(mysql_engine_pool, df_to_records(df), list(df), table_name)
+
+def df_to_records(df: pd.DataFrame):
+    # object conversion gives python scalars the driver can escape, and missing values become NULL
+    return df.astype(object).where(df.notna(), None).values.tolist()
+
+async def records_to_sql(mysql_engine_pool: aiomysql.Pool, records: list, columns: list, table_name: str, update_cols: list=None):
+    # executemany rewrites a parameterized INSERT into multi row statements.
+    # With update_cols rows hitting a unique key are updated instead of duplicated
+    placeholder_str = ','.join(['%s'] * len(columns))
+    sql_query = f"INSERT INTO {table_name} ({','.join(columns)}) VALUES ({placeholder_str})"
+    if update_cols:
+        sql_query += ' ON DUPLICATE KEY UPDATE ' + ', '.join([f'{col} = VALUES({col})' for col in update_cols])
     conn = await mysql_engine_pool.acquire()
     cur = await conn.cursor()
-    await cur.execute(sql_query)
+    await cur.executemany(sql_query, records)
+    metrics_utils.record(db_round_trips=1)
     await cur.close()
     await mysql_engine_pool.release(conn)
 
+async def df_to_sql_infile(mysql_engine_pool: aiomysql.Pool, df: pd.DataFrame, table_name: str, replace: bool=False):
+    # the frame is written by the C csv writer into a temp file and streamed by the server with LOAD DATA,
+    # so nothing is formatted row by row in python. The pool must be created with local_infile=True
+    ts = time.time()
+    columns = list(df)
+    tmp_file = tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False, encoding='utf-8')
+    tmp_file.close()
+    try:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, partial(df.to_csv, tmp_file.name, header=False, index=False, na_rep=''))
+        var_str = ','.join([f'@v{i}' for i in range(len(columns))])
+        set_str = ', '.join([f"{col} = NULLIF(@v{i}, '')" for i, col in enumerate(columns)])
+        sql_query = f"""
+        LOAD DATA LOCAL INFILE %s {'REPLACE' if replace else ''} INTO TABLE {table_name}
+        CHARACTER SET utf8mb4
+        FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' ESCAPED BY ''
+        LINES TERMINATED BY '\\n'
+        ({var_str}) SET {set_str}
+        """
+        conn = await mysql_engine_pool.acquire()
+        cur = await conn.cursor()
+        await cur.execute(sql_query, (tmp_file.name, ))
+        metrics_utils.record(db_round_trips=1)
+        await cur.close()
+        await mysql_engine_pool.release(conn)
+    finally:
+        os.remove(tmp_file.name)
+    seconds = time.time() - ts
+    logging.info(f'loaded {len(df)} rows into {table_name} in {seconds:.2f} s ({len(df) / max(seconds, 1e-6):.0f} rows/s)')
+    return len(df)
+
 async def get_latest_date_in_table(mysql_engine_pool: aiomysql.Pool, table_name: str, date_col: str='date'):
     sql_query = f'SELECT MAX({date_col}) FROM {table_name}'
     conn = await mysql_engine_pool.acquire()
@@ -137,6 +226,35 @@ def delete_table(db_engine: sqlalchemy.engine, table: str):
 def truncate_table(db_engine: sqlalchemy.engine, table: str):
     db_engine.execute(f'TRUNCATE TABLE {table}')
 
+async def execute_query(mysql_engine_pool: aiomysql.Pool, sql_query: str):
+    conn = await mysql_engine_pool.acquire()
+    cur = await conn.cursor()
+    await cur.execute(sql_query)
+    metrics_utils.record(db_round_trips=1)
+    await cur.close()
+    await mysql_engine_pool.release(conn)
+
+async def drop_table(mysql_engine_pool: aiomysql.Pool, table_name: str):
+    await execute_query(mysql_engine_pool, f'DROP TABLE IF EXISTS {table_name}')
+
+async def add_indexes(mysql_engine_pool: aiomysql.Pool, table_name: str, index_lst: list):
+    # one ALTER builds every index in a single pass over the table
+    if index_lst:
+        await execute_query(mysql_engine_pool, f"ALTER TABLE {table_name} {', '.join([f'ADD INDEX ({index})' for index in index_lst])}")
+
+async def swap_in_table(mysql_engine_pool: aiomysql.Pool, staging_name: str, table_name: str, index_lst: list=None):
+    # builds the indexes on the loaded staging table and replaces table_name with it in one atomic RENAME,
+    # so readers see either the old or the new table, never a partial load
+    await add_indexes(mysql_engine_pool, staging_name, index_lst)
+    schema_name, table = table_name.split('.')
+    old_name = f'{table_name}__old'
+    await drop_table(mysql_engine_pool, old_name)
+    if await table_exists(mysql_engine_pool, schema_name, table):
+        await execute_query(mysql_engine_pool, f'RENAME TABLE {table_name} TO {old_name}, {staging_name} TO {table_name}')
+    else:
+        await execute_query(mysql_engine_pool, f'RENAME TABLE {staging_name} TO {table_name}')
+    await drop_table(mysql_engine_pool, old_name)
+
 async def table_exists(mysql_engine_pool: aiomysql.pool, schema_name: str, table_name: str):
     sql_query = f'''
     SELECT EXISTS (SELECT * 
@@ -148,6 +266,7 @@ async def table_exists(mysql_engine_pool: aiomysql.pool, schema_name: str, table
     conn = await mysql_engine_pool.acquire()
     cur = await conn.cursor()
     await cur.execute(sql_query)
+    metrics_utils.record(db_round_trips=1)
     (exists_num, ) = await cur.fetchone()
 
     await cur.close()
@@ -158,20 +277,47 @@ async def table_exists(mysql_engine_pool: aiomysql.pool, schema_name: str, table
         exists = True
     return exists
 
-async def several_updates_table(mysql_engine_pool: aiomysql.Pool, table_name: str, update_df: pd.DataFrame, index_df: pd.DataFrame):
+async def several_updates_table(mysql_engine_pool: aiomysql.Pool, table_name: str, update_df: pd.DataFrame, index_df: pd.DataFrame, chunksize: int=5000):
+    # the rows are bulk loaded into a temporary table and applied with a single UPDATE ... JOIN,
+    # so the cost is a few round trips instead of one per row. Temporary tables live on one connection,
+    # so everything runs on the same one
     assert len(index_df) == len(update_df), 'index_df and update_df is not the same length'
-    for i in range(len(index_df)):
-        try: 
-            update_dct = update_df.iloc[i].to_dict()
-        except AttributeError: 
-            update_dct = {update_df.name: update_df.iloc[i]}
-
-        try: 
-            index_dct = index_df.iloc[i].to_dict()
-        except AttributeError: 
-            index_dct = {index_df.name: index_df.iloc[i]}
+    if isinstance(update_df, pd.Series):
+        update_df = update_df.to_frame()
+    if isinstance(index_df, pd.Series):
+        index_df = index_df.to_frame()
+    index_cols = list(index_df)
+    update_cols = list(update_df)
+    df = pd.concat([index_df.reset_index(drop=True), update_df.reset_index(drop=True)], axis=1)
+
+    dtype_trans_dct = get_dtype_trans(df)
+    unmapped_cols = [col for col in list(df) if col not in dtype_trans_dct]
+    if unmapped_cols:
+        raise ValueError(f"several_updates_table has no sql type for {', '.join([f'{col} ({df[col].dtype})' for col in unmapped_cols])}")
+    tmp_name = f'tmp_update_{uuid.uuid4().hex[:12]}'
+    col_definition_str = ', '.join([f'{k} {v}' for k, v in dtype_trans_dct.items()])
+    placeholder_str = ','.join(['%s'] * len(list(df)))
+    join_str = ' AND '.join([f't.{col} = u.{col}' for col in index_cols])
+    set_str = ', '.join([f't.{col} = u.{col}' for col in update_cols])
+    records = df_to_records(df)
 
-        await update_table(mysql_engine_pool, table_name, update_dct, index_dct)
+    conn = await mysql_engine_pool.acquire()
+    cur = await conn.cursor()
+    try:
+        await cur.execute(f"CREATE TEMPORARY TABLE {tmp_name} ({col_definition_str}, INDEX ({', '.join(index_cols)}))")
+        for i in range(0, len(records), chunksize):
+            await cur.executemany(f"INSERT INTO {tmp_name} ({','.join(list(df))}) VALUES ({placeholder_str})", records[i:i+chunksize])
+        await cur.execute(f'UPDATE {table_name} t JOIN {tmp_name} u ON {join_str} SET {set_str}')
+        updated_rows = cur.rowcount
+    finally:
+        # the connection goes back to the pool, where a leftover temporary table would outlive the call
+        try:
+            await cur.execute(f'DROP TEMPORARY TABLE IF EXISTS {tmp_name}')
+        finally:
+            await cur.close()
+            await mysql_engine_pool.release(conn)
+    logging.info(f'updated {updated_rows} rows in {table_name} from {len(records)} update rows')
+    return updated_rows
 
 async def update_table(mysql_engine_pool: aiomysql.Pool, table_name: str, update_dct: dict, index_dct: dict):
     update_string = ', '.join(f"{key}='{value}'" for key, value in update_dct.items())
@@ -229,6 +375,40 @@ async def table_empty(mysql_engine_pool: aiomysql.pool, table_name: str):
         empty = True
     return empty
 
+async def get_sync_state(mysql_engine_pool: aiomysql.Pool, schema_name: str, table_names: list, date_col: str='time'):
+    # existence, row presence and latest period of every table in two queries, instead of three round trips per table
+    state = {table_name: {'exists': False, 'has_data': False, 'latest_date': None} for table_name in table_names}
+    if not table_names:
+        return state
+    conn = await mysql_engine_pool.acquire()
+    cur = await conn.cursor()
+    await cur.execute(f"SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME IN ({','.join(['%s'] * len(table_names))})", (schema_name, *table_names))
+    existing = [table_name for (table_name, ) in await cur.fetchall() if table_name in state]
+    if existing:
+        await cur.execute(' UNION ALL '.join([f"SELECT '{table_name}', MAX({date_col}) FROM {schema_name}.{table_name}" for table_name in existing]))
+        latest_dates = dict(await cur.fetchall())
+    await cur.close()
+    await mysql_engine_pool.release(conn)
+    for table_name in existing:
+        state[table_name] = {'exists': True, 'has_data': latest_dates[table_name] is not None, 'latest_date': latest_dates[table_name]}
+    return state
+
+async def read_sync_ledger(mysql_engine_pool: aiomysql.Pool, ledger_name: str):
+    # what DST had published, and with which metadata, when each table was last loaded
+    await create_table(mysql_engine_pool, ledger_name, col_datatype_dct={'table_id': 'VARCHAR(32) PRIMARY KEY', 'dst_updated': 'DATETIME', 'metadata_hash': 'CHAR(64)', 'loaded_rows': 'INT', 'loaded_at': 'DATETIME'})
+    conn = await mysql_engine_pool.acquire()
+    cur = await conn.cursor()
+    await cur.execute(f'SELECT table_id, dst_updated, metadata_hash FROM {ledger_name}')
+    metrics_utils.record(db_round_trips=1)
+    rows = await cur.fetchall()
+    await cur.close()
+    await mysql_engine_pool.release(conn)
+    return {table_id: {'dst_updated': dst_updated, 'metadata_hash': metadata_hash} for table_id, dst_updated, metadata_hash in rows}
+
+async def write_sync_ledger(mysql_engine_pool: aiomysql.Pool, ledger_name: str, table_id: str, dst_updated, metadata_hash: str, loaded_rows: int):
+    columns = ['table_id', 'dst_updated', 'metadata_hash', 'loaded_rows', 'loaded_at']
+    await records_to_sql(mysql_engine_pool, [[table_id, dst_updated, metadata_hash, loaded_rows, datetime.now()]], columns, ledger_name, update_cols=columns[1:])
+
 async def table_exists_notempty(mysql_engine_pool: str, schema_name: str, table_name: str):
     exists = await table_exists(mysql_engine_pool, schema_name, table_name)
     if exists:
@@ -261,28 +441,147 @@ def table_index_exists(db_engine: sqlalchemy.engine, schema: str, table: str, in
 async def col_dtypes(mysql_engine_pool: aiomysql.pool, schema_name: str, table_name: str):
     conn = await mysql_engine_pool.acquire()
     cur = await conn.cursor()
-    await cur.execute(f"SELECT column_name, data_type FROM information_schema.columns where table_schema = '{schema_name}' and table_name='{table_name}'")
+    await cur.execute(f"SELECT column_name, data_type FROM information_schema.columns where table_schema = '{schema_name}' and table_name='{table_name}' ORDER BY ordinal_position")
     res = await cur.fetchall()
     await cur.close()
     await mysql_engine_pool.release(conn)
     col_dtypes = {column_name: data_type for column_name, data_type in res}
     return col_dtypes
 
-def load_data(engine: sqlalchemy.engine, sql_query: str):
-    df_load = pd.read_sql(sql_query, engine, chunksize=20000)
+# arrow types of the mysql data types, anything else is read as strings
+ARROW_TYPES = {
+    'tinyint': pa.int64(),
+    'smallint': pa.int64(),
+    'mediumint': pa.int64(),
+    'int': pa.int64(),
+    'bigint': pa.int64(),
+    'year': pa.int64(),
+    'float': pa.float32(),
+    'double': pa.float64(),
+    'decimal': pa.float64(),
+    'date': pa.date32(),
+    'datetime': pa.timestamp('us'),
+    'timestamp': pa.timestamp('us'),
+    'time': pa.duration('us'),
+    'char': pa.string(),
+    'varchar': pa.string(),
+    'tinytext': pa.string(),
+    'text': pa.string(),
+    'mediumtext': pa.string(),
+    'longtext': pa.string(),
+    'enum': pa.string(),
+    'set': pa.string(),
+    'json': pa.string(),
+    'bit': pa.binary(),
+    'binary': pa.binary(),
+    'varbinary': pa.binary(),
+    'tinyblob': pa.binary(),
+    'blob': pa.binary(),
+    'mediumblob': pa.binary(),
+    'longblob': pa.binary(),
+}
+
+def build_select(table_name: str, columns: list, filters: dict=None, since=None, until=None, date_col: str='time'):
+    # filters are {col: value or list of values}, since and until bound date_col, until is exclusive
+    where_strs = []
+    args = []
+    for col, values in (filters or {}).items():
+        values = list(values) if isinstance(values, (list, tuple, set)) else [values]
+        where_strs.append(f"{col} IN ({','.join(['%s'] * len(values))})")
+        args += values
+    if since is not None:
+        where_strs.append(f'{date_col} >= %s')
+        args.append(since)
+    if until is not None:
+        where_strs.append(f'{date_col} < %s')
+        args.append(until)
+    sql_query = f"SELECT {', '.join(columns)} FROM {table_name}"
+    if where_strs:
+        sql_query += f" WHERE {' AND '.join(where_strs)}"
+    return sql_query, args
+
+async def table_watermark(mysql_engine_pool: aiomysql.Pool, schema_name: str, table_name: str):
+    # changes when the table is written or swapped. UPDATE_TIME only has whole seconds, so a table written in the
+    # current second could be written again without the watermark changing. Such a table, and one the server
+    # doesn't track writes for, gets None, which leaves the read uncached
+    conn = await mysql_engine_pool.acquire()
+    cur = await conn.cursor()
+    await cur.execute('SELECT CREATE_TIME, UPDATE_TIME, UPDATE_TIME < CAST(NOW() AS DATETIME(0)) FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s', (schema_name, table_name))
+    row = await cur.fetchone()
+    await cur.close()
+    await mysql_engine_pool.release(conn)
+    if not row or row[1] is None or not row[2]:
+        return None
+    return f'{row[0]}/{row[1]}'
+
+def to_arrow_array(values: tuple, arrow_type: pa.DataType):
+    # driver values that don't convert directly, like Decimal to float64, are inferred and then cast
     try:
-        df = pd.concat([chunk for chunk in tqdm(df_load, desc='Loading data', file=sys.stdout)], ignore_index=True)
-    except ValueError:
-        logging.error('No data in sql query table')
-        df = pd.DataFrame()
-    return df
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        return pa.array(values).cast(arrow_type)
+
+def rows_to_batch(rows: list, schema: pa.Schema):
+    # the rows are transposed once and every column becomes one typed arrow array
+    columns = list(zip(*rows))
+    return pa.RecordBatch.from_arrays([to_arrow_array(values, field.type) for values, field in zip(columns, schema)], schema=schema)
+
+async def read_table(mysql_engine_pool: aiomysql.Pool, table_name: str, columns: list=None, filters: dict=None, since=None, until=None, batch_rows: int=50000, result_cache: ResultCache=None, date_col: str='time'):
+    # streams the selected columns and rows as arrow record batches. Only the filtered columns and rows leave
+    # the server, and the server side cursor holds one batch in memory at a time.
+    # With result_cache, a read of a table that hasn't changed since the same read comes from a local file
+    schema_name, table = table_name.split('.')
+    dtypes = await col_dtypes(mysql_engine_pool, schema_name, table)
+    columns = columns or list(dtypes)
+    unknown_cols = [col for col in columns + list(filters or {}) if col not in dtypes]
+    if unknown_cols:
+        raise ValueError(f"{table_name} has no columns {', '.join(unknown_cols)}")
+    schema = pa.schema([(col, ARROW_TYPES.get(dtypes[col], pa.string())) for col in columns])
+    sql_query, args = build_select(table_name, columns, filters, since, until, date_col)
+
+    key = None
+    if result_cache:
+        watermark = await table_watermark(mysql_engine_pool, schema_name, table)
+        key = result_cache.key(sql_query, args, watermark) if watermark else None
+        if key and result_cache.exists(key):
+            with result_cache.open(key) as batch_reader:
+                for i in range(batch_reader.num_record_batches):
+                    yield batch_reader.get_batch(i)
+            return
 
+    conn = await mysql_engine_pool.acquire()
+    cur = await conn.cursor(aiomysql.SSCursor)
+    try:
+        await cur.execute(sql_query, args)
+        metrics_utils.record(db_round_trips=1)
+        with result_cache.writer(key, schema) if key else nullcontext() as batch_writer:
+            while True:
+                rows = await cur.fetchmany(batch_rows)
+                if not rows:
+                    break
+                batch = rows_to_batch(rows, schema)
+                if batch_writer:
+                    batch_writer.write_batch(batch)
+                yield batch
+    finally:
+        # closing an unbuffered cursor reads what is left of the result
+        await cur.close()
+        await mysql_engine_pool.release(conn)
+
+async def read_frame(mysql_engine_pool: aiomysql.Pool, table_name: str, columns: list=None, filters: dict=None, since=None, until=None, batch_rows: int=50000, result_cache: ResultCache=None, date_col: str='time'):
+    # the whole result as a frame, converted from arrow once instead of concatenating frames of every chunk
+    batches = [batch async for batch in read_table(mysql_engine_pool, table_name, columns, filters, since, until, batch_rows, result_cache, date_col)]
+    if not batches:
+        logging.info(f'no rows in {table_name} for the filters')
+        return pd.DataFrame(columns=columns)
+    return pa.Table.from_batches(batches).to_pandas(date_as_object=False)
 
 def get_dtype_trans(df: pd.DataFrame, str_len: int=150):
-    obj_vars = [colname for colname in list(df) if df[colname].dtype == 'object']
-    int_vars = [colname for colname in list(df) if df[colname].dtype == 'int64']
-    float_vars = [colname for colname in list(df) if df[colname].dtype == 'float64']
-    date_vars = [colname for colname in list(df) if df[colname].dtype == 'datetime64[ns]']
+    # categories, pandas string columns and downcast numbers map to the same sql types as their plain counterparts
+    obj_vars = [colname for colname in list(df) if df[colname].dtype == 'object' or df[colname].dtype.name == 'category' or isinstance(df[colname].dtype, pd.StringDtype)]
+    int_vars = [colname for colname in list(df) if pd.api.types.is_integer_dtype(df[colname].dtype)]
+    float_vars = [colname for colname in list(df) if pd.api.types.is_float_dtype(df[colname].dtype)]
+    date_vars = [colname for colname in list(df) if pd.api.types.is_datetime64_any_dtype(df[colname].dtype)]
 
     dtype_trans = {
         obj_var: f"VARCHAR({str_len})" for obj_var in obj_vars
@@ -296,4 +595,24 @@ def get_dtype_trans(df: pd.DataFrame, str_len: int=150):
     dtype_trans.update({
         date_var: "DATE" for date_var in date_vars
     })
-    return dtype_trans
\ No newline at end of file
+    return dtype_trans
+
+def code_sql_type(codes: list):
+    # the smallest type holding the code ids of a variable. Numeric codes with leading zeros stay CHAR, so '000' isn't read back as 0
+    if codes and all(code.isdigit() and (code == '0' or not code.startswith('0')) for code in codes):
+        max_value = max(int(code) for code in codes)
+        if max_value < 2**8:
+            return 'TINYINT UNSIGNED'
+        elif max_value < 2**16:
+            return 'SMALLINT UNSIGNED'
+        elif max_value < 2**32:
+            return 'INT UNSIGNED'
+    max_len = max([len(code) for code in codes] + [1])
+    if all(code.isascii() for code in codes):
+        return f'CHAR({max_len}) CHARACTER SET ascii'
+    return f'CHAR({max_len})'
+
+async def write_dimension_table(mysql_engine_pool: aiomysql.Pool, table_name: str, codes: list, labels: list):
+    # code to label lookup for a variable stored as code ids in a fact table
+    await create_table(mysql_engine_pool, table_name, col_datatype_dct={'code': f'{code_sql_type(codes)} PRIMARY KEY', 'label': 'VARCHAR(255)'})
+    await records_to_sql(mysql_engine_pool, [list(record) for record in zip(codes, labels)], ['code', 'label'], table_name, update_cols=['label'])
@@ -0,0 +1,61 @@
+from datetime import datetime, date
+import re
+import pandas as pd
+
+
+# months in a period for each DST time code letter, plain years have no letter
+GRANULARITY_MONTHS = {
+    'Y': 12,
+    'H': 6,
+    'K': 3,
+    'M': 1,
+}
+TIME_CODE = re.compile(r'^(\d{4})(?:([HKM])(\d{1,2}))?$')
+
+
+def time_code_granularity(code: str):
+    re_obj = TIME_CODE.match(code)
+    if not re_obj:
+        raise ValueError(f'{code} is not a yearly, half year, quarterly or monthly time code')
+    return re_obj[2] or 'Y'
+
+def detect_granularity(codes: list):
+    # the finest granularity among the codes, so filters built from it never skip a period
+    granularities = {time_code_granularity(code) for code in codes}
+    return min(granularities, key=GRANULARITY_MONTHS.get)
+
+def parse_time_code(code: str):
+    re_obj = TIME_CODE.match(code)
+    if not re_obj:
+        raise ValueError(f'{code} is not a yearly, half year, quarterly or monthly time code')
+    granularity = re_obj[2] or 'Y'
+    number = int(re_obj[3]) if re_obj[3] else 1
+    return datetime(int(re_obj[1]), (number - 1) * GRANULARITY_MONTHS[granularity] + 1, 1)
+
+def parse_time_column(time_col: pd.Series):
+    # a table has few distinct periods, so each code is parsed once and mapped onto the column
+    codes = pd.unique(time_col.astype(str))
+    period_starts = {code: parse_time_code(code) for code in codes}
+    return pd.to_datetime(time_col.astype(str).map(period_starts))
+
+def period_code(period_start: datetime, granularity: str):
+    if granularity == 'Y':
+        return f'{period_start.year}'
+    elif granularity == 'M':
+        return f'{period_start.year}M{period_start.month:02d}'
+    period_number = (period_start.month - 1) // GRANULARITY_MONTHS[granularity] + 1
+    return f'{period_start.year}{granularity}{period_number}'
+
+def to_datetime(value):
+    # the stored max is a date, but older tables kept the raw DST code
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    return parse_time_code(str(value))
+
+def refetch_start(latest_date: datetime, granularity: str, refetch_periods: int=0):
+    # the periods after this date are fetched again, reaching refetch_periods back from latest_date to pick up revisions
+    return (latest_date - pd.DateOffset(months=GRANULARITY_MONTHS[granularity] * refetch_periods)).to_pydatetime()
+
+def time_filter(start_date: datetime, granularity: str):
+    # api filter for the periods after start_date
+    return f'>{period_code(start_date, granularity)}'
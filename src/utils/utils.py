@@ -90,6 +90,26 @@ def multiple_replace(replace_dct: dict, text: str, **kwargs):
 def mark_list_duplicates(lst: list):
     return [True if lst.count(col)>1 else False for col in lst]
 
+def sql_identifier(text: str):
+    # a column name MariaDB takes unquoted, from a DST variable text like 'type of income (DKK)'
+    name = re.sub(r'\W+', '_', text).strip('_').lower()[:60]
+    return name if name and not name[0].isdigit() else f'v_{name}'
+
+def column_names(col_names_dct: dict, reserved: tuple=('content', )):
+    # the column name of every variable of a table. Texts that end up the same get a numbered suffix,
+    # in variable order, so a table always gets the same names
+    names = {}
+    taken = set(reserved)
+    for variable_id, text in col_names_dct.items():
+        name = base = sql_identifier(text)
+        suffix = 2
+        while name in taken:
+            name = f'{base}_{suffix}'
+            suffix += 1
+        taken.add(name)
+        names[variable_id] = name
+    return names
+
 def split_list(lst: list, chunk_size: int):
     return [lst[offs:offs+chunk_size] for offs in range(0, len(lst), chunk_size)]
 
@@ -110,6 +130,27 @@ def logical_operator_render(val1: str, val2: str, string_operator: str='=='):
 
     return NotImplementedError("this string operator isn't implemented")
 
+def parse_operator(expression: str):
+    # splits an operator expression like '>2014M12' into ('>', '2014M12'), None if it isn't one
+    re_obj = re.match(r'\s*(>=|<=|==|>|<|=)\s*(.+)$', expression)
+    if not re_obj:
+        return None
+    return re_obj[1], re_obj[2]
+
+def parse_operator_value(expression: str):
+    # splits a numeric operator expression like '>=100' into ('>=', 100.0), None if it isn't one
+    parsed = parse_operator(expression)
+    if not parsed or not is_number(parsed[1]):
+        return None
+    return parsed[0], float(parsed[1])
+
+def is_number(value: str):
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
 def date_cat(dates, days: int=14):
     bins_dt = pd.date_range(min(dates), max(dates)+timedelta(days=days), freq=f"{days}D")
     bins_str = bins_dt.astype(str).values